@@ -5,8 +5,9 @@ load OGR-compatible data sources and simplify the linework while preserving
 topology. The simplify() method accepts tolerances in map units, so
 simplification can be performed by known amounts with predictable outcomes.
 
-Dependencies include Warmerdam (http://trac.osgeo.org/gdal/wiki/GdalOgrInPython)
-and Gillies (http://trac.gispython.org/lab/wiki/Rtree, http://trac.gispython.org/lab/wiki/Shapely).
+Dependencies include Warmerdam (http://trac.osgeo.org/gdal/wiki/GdalOgrInPython),
+Gillies (http://trac.gispython.org/lab/wiki/Rtree, http://trac.gispython.org/lab/wiki/Shapely)
+and NumPy (http://numpy.scipy.org).
 
 Example usage:
 
@@ -27,26 +28,47 @@ Example usage:
   
   # Save it out to a new GeoJSON file.
   save(datasrc, 'output2.json')
+  
+  # Load states and counties together so their borders stay coincident.
+  datasrc = load(['states.shp', 'counties.shp'], builder='arcs')
+  datasrc.simplify(500)
+  
+  # Save each layer to its own file.
+  save(datasrc, 'states-simple.shp', layer='states')
+  save(datasrc, 'counties-simple.shp', layer='counties')
 
 """
 
 from sys import stderr
-from os.path import splitext
-from itertools import combinations, permutations
+from array import array
+from os import stat
+from time import time
+from math import floor, hypot
+from os.path import splitext, abspath, exists, basename
+from json import dumps as json_dumps, loads as json_loads
+from heapq import heapify, heappush, heappop
+from struct import pack, unpack
+from operator import itemgetter
+from itertools import combinations, permutations, groupby, izip
 from sqlite3 import connect
+from collections import OrderedDict
+from multiprocessing import Pool
 
-from osgeo import ogr
+import numpy
+from osgeo import ogr, osr
 from rtree import Rtree
-from rtree.core import RTreeError
 from shapely.geos import lgeos
-from shapely.geometry import MultiLineString, LineString, Polygon, Point
+from shapely.geometry import MultiLineString, LineString, Point, Polygon, MultiPolygon
 from shapely.geometry.base import geom_factory
 from shapely.wkb import loads, dumps
-from shapely.ops import polygonize
+from shapely.ops import polygonize, unary_union
 
 drivers = {'.shp': 'ESRI Shapefile', '.json': 'GeoJSON'}
 
-__all__ = ['load', 'save', 'Datasource']
+# written by GeoJSONWriter instead of OGR, with whether features are newline-delimited
+geojson_formats = {'.geojson': False, '.geojsonl': True, '.ndjson': True}
+
+__all__ = ['load', 'save', 'dump_topology', 'load_topology', 'topology_matches', 'simplify_partitioned', 'Datasource']
 
 class Field:
     """
@@ -56,24 +78,244 @@ class Field:
         self.type = type
         self.width = width
 
-class Datasource:
-    """ Store an exploded representation of a data source, so it can be simplified.
+class Layer:
+    """ One source layer of a Datasource, covering a range of its feature indexes.
     """
-    def __init__(self, srs, geom_type, fields, values, shapes):
-        """ Use load() to call this constructor.
-        """
+    def __init__(self, name, srs, geom_type, fields, start, count):
+        self.name = name
         self.srs = srs
-        self.fields = fields
         self.geom_type = geom_type
-        self.values = values
-        self.shapes = shapes
+        self.fields = fields
+        self.start = start
+        self.count = count
+    
+    def indexes(self):
+        return range(self.start, self.start + self.count)
+    
+    def __getstate__(self):
+        # spatial references can't be pickled, so they travel as WKT.
+        state = dict(self.__dict__)
+        state['srs'] = self.srs and self.srs.ExportToWkt()
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.srs = self.srs and osr.SpatialReference(self.srs)
 
-        # this will be changed later
-        self.tolerance = 0
+class SourceValues:
+    """ Sequence of field value lists, read from OGR data sources on demand.
+    
+        Sources are a list of (filename, layer, fields), and each feature is
+        found by its source number and feature id. Only those are kept in
+        memory, so sources must not change before the values are read by save().
+    """
+    def __init__(self, sources, source_ids, fids):
+        self.sources = sources
+        self.source_ids = source_ids
+        self.fids = fids
+        self.layers = {}
+    
+    def __len__(self):
+        return len(self.fids)
+    
+    def __getitem__(self, index):
+        k, fid = self.source_ids[index], self.fids[index]
+        filename, layer, fields = self.sources[k]
+        
+        if k not in self.layers:
+            # the data source is kept with its layer so it isn't closed.
+            source = ogr.Open(filename)
+            self.layers[k] = source, source.GetLayer(layer)
+        
+        feature = self.layers[k][1].GetFeature(fid)
+        return [feature.GetField(field.name) for field in fields]
+    
+    def __getstate__(self):
+        # open layers aren't pickled, and get opened again when needed.
+        state = dict(self.__dict__)
+        state['layers'] = {}
+        return state
+
+class WKBShapes:
+    """ Sequence of shapes kept as WKB strings, parsed on demand.
+    
+        Up to cache_size parsed shapes are kept in a BoundedCache.
+    """
+    def __init__(self, wkbs, cache_size=None):
+        self.wkbs = wkbs
+        self.shape = BoundedCache(self._parse, cache_size)
+    
+    def _parse(self, index):
+        return loads(self.wkbs[index])
+    
+    def __len__(self):
+        return len(self.wkbs)
+    
+    def __getitem__(self, index):
+        return self.shape(index)
+
+class Grid:
+    """ Square grid that load() can snap coordinates to before finding borders.
+    
+        Points are stored as whole numbers of cells, counted from the cell
+        at column and row of a grid that starts at zero, so every grid of
+        the same size snaps to the same points. Coord_type is an integer type big enough
+        for every cell in the extent the grid was made for by make_grid().
+    """
+    def __init__(self, size, column, row, coord_type=numpy.int64):
+        self.size = float(size)
+        self.column, self.row = column, row
+        self.coord_type = numpy.dtype(coord_type)
+    
+    def cells(self, coords):
+        """ Return an (n, 2) array of cells for a sequence of map coordinates.
+        """
+        return numpy.round(numpy.array(coords, numpy.float64)[:,:2] / self.size) - (self.column, self.row)
+    
+    def points(self, cells):
+        """ Return a list of (x, y) map coordinates for a sequence of cells.
+        """
+        return map(tuple, ((numpy.array(cells, numpy.float64) + (self.column, self.row)) * self.size).tolist())
+    
+    def clusters(self, points, distance=None):
+        """ Return a dictionary of cells for points with other points nearby.
+        
+            Points closer together than distance, half a cell by default,
+            are found by point_groups(), and every point in a group goes to
+            the cell nearest the middle of the group. Copies of a vertex that
+            rounding would split between cells always meet, whatever order
+            points come in. Groups chained wider than one cell are split again
+            at half the distance, so a densely digitized line isn't pulled
+            into a single point.
+        """
+        distance, clusters = distance or self.size / 2, {}
+        
+        for group in point_groups(points, distance):
+            xs, ys = zip(*sorted(group))
+            
+            if max(xs) - min(xs) > self.size or max(ys) - min(ys) > self.size:
+                clusters.update(self.clusters(group, distance / 2))
+                continue
+            
+            cell = tuple(self.cells([(sum(xs) / len(xs), sum(ys) / len(ys))])[0].tolist())
+            clusters.update([(point, cell) for point in group])
+        
+        return clusters
+    
+    def snap(self, shape, clusters=None, pixels=None):
+        """ Return a polygon or multipolygon in cells, possibly empty.
+        
+            Clusters is an optional dictionary from clusters(), moving
+            some points to the cell of their group instead of the nearest.
+            Pixels is an optional HotPixels of every snapped vertex, which
+            segments are bent through where they pass close by.
+            
+            Shells are turned counterclockwise and holes clockwise. Rings that
+            snap to fewer than three distinct points are dropped, along with
+            the holes of any polygon whose shell is dropped. Shapes made
+            invalid by snapping are rebuilt by repair().
+        """
+        polygons = []
+        
+        for polygon in (shape.geoms if hasattr(shape, 'geoms') else [shape]):
+            if polygon.is_empty:
+                continue
+            
+            rings = []
+            
+            for (k, ring) in enumerate([polygon.exterior] + list(polygon.interiors)):
+                cells = map(tuple, self.cells(ring.coords).tolist())
+                
+                if clusters:
+                    cells = [clusters.get(point[:2], cell) for (point, cell) in zip(ring.coords, cells)]
+                
+                if ring.is_ccw == bool(k):
+                    cells.reverse()
+                
+                cells = distinct_points(cells)
+                rings.append(cells if pixels is None else pixels.bend(cells))
+            
+            rings = [(ring if len(ring) >= 4 else None) for ring in rings]
+            
+            if rings[0] is not None:
+                polygons.append((rings[0], [ring for ring in rings[1:] if ring is not None]))
+        
+        if not polygons:
+            return MultiPolygon()
+        
+        snapped = Polygon(*polygons[0]) if len(polygons) == 1 else MultiPolygon(polygons)
+        
+        return snapped if snapped.is_valid else self.repair(snapped)
+    
+    def repair(self, snapped):
+        """ Return a valid version of a snapped shape that crosses itself.
+        
+            Ring segments are noded against each other and polygonized,
+            and faces are kept where the rings wind counterclockwise, so no
+            area is lost the way buffer(0) can lose it. A border folded over
+            by snapping winds one way for the feature on one side of it and
+            the other way for its neighbor, so only one of them keeps the
+            fold. Points where rings cross can fall between cells until
+            insert_line() rounds them.
+        """
+        rings = shape_rings(snapped)
+        lines = [LineString([ring[k - 1], ring[k]]) for ring in rings for k in range(len(ring))]
+        faces = []
+        
+        for face in polygonize(unary_union(lines)):
+            point = face.representative_point().coords[0]
+            
+            if sum([winding_number(point, ring) for ring in rings]) > 0:
+                faces.append(face)
+        
+        return unary_union(faces) if faces else MultiPolygon()
+
+class HotPixels:
+    """ Cells holding snapped vertices, used to snap round segments in cells.
+    
+        A segment that passes through the square of another vertex's cell
+        is bent through that cell, so a border that snapping moves across
+        a neighbor's vertex meets it instead of crossing it. Borders shared
+        by two shapes are bent through the same cells from either side.
+    """
+    def __init__(self, cells):
+        self.cells = list(cells)
+        self.rtree = Rtree([(k, (x - .5, y - .5, x + .5, y + .5), None) for (k, (x, y)) in enumerate(self.cells)]) if self.cells else Rtree()
+    
+    def crossed(self, start, end):
+        """ Return cells other than start and end that a segment passes through, in order.
+        """
+        (x1, y1), (x2, y2) = start, end
+        length, crossed = float((x2 - x1) ** 2 + (y2 - y1) ** 2), []
+        
+        for k in self.rtree.intersection(bbox(x1, y1, x2, y2)):
+            cell = self.cells[k]
+            
+            if cell != start and cell != end and crosses_square(start, end, cell, .5):
+                position = ((cell[0] - x1) * (x2 - x1) + (cell[1] - y1) * (y2 - y1)) / length
+                crossed.append((position, cell))
+        
+        return [cell for (position, cell) in sorted(crossed)]
+    
+    def bend(self, points):
+        """ Return a list of points with the cells crossed by each segment added.
+        """
+        bent = points[:1]
         
-        # guid, src1_id, src2_id, line_id, x1, y1, x2, y2
+        for (start, end) in zip(points[:-1], points[1:]):
+            bent.extend(self.crossed(start, end))
+            bent.append(end)
         
+        return bent
+
+class SQLiteSegments:
+    """ Segments stored in an in-memory SQLite table.
+    
+        Coordinates are stored as INTEGER when coord_type is an integer type.
+    """
+    def __init__(self, coord_type=numpy.float64):
         db = connect(':memory:').cursor()
+        sql_type = 'INTEGER' if numpy.dtype(coord_type).kind == 'i' else 'REAL'
         
         db.execute("""CREATE table segments (
                         
@@ -88,355 +330,1437 @@ class Datasource:
                         line_id INTEGER,
                         
                         -- start and end coordinates for this segment
-                        x1      REAL,
-                        y1      REAL,
-                        x2      REAL,
-                        y2      REAL,
+                        x1      %(sql_type)s,
+                        y1      %(sql_type)s,
+                        x2      %(sql_type)s,
+                        y2      %(sql_type)s,
                         
                         -- flag
-                        removed INTEGER
+                        removed INTEGER,
+                        
+                        -- effective area of the starting vertex when it was removed
+                        area    REAL
         
-                      )""")
+                      )""" % locals())
         
         db.execute('CREATE INDEX segments_lines ON segments (line_id, guid)')
         db.execute('CREATE INDEX shape1_parts ON segments (src1_id)')
         db.execute('CREATE INDEX shape2_parts ON segments (src2_id)')
         
         self.db = db
-        self.rtree = Rtree()
-        self.memo_line = make_memo_line()
-
-    def _indexes(self):
-        return range(len(self.values))
+        self.coord_type = coord_type
     
-    def simplify(self, tolerance, verbose=False):
-        """ Simplify the polygonal linework.
-        
-            This method can be called multiple times, but the process is
-            destructive so it must be called with progressively increasing
-            tolerance values.
+    def insert(self, src1_id, src2_id, line_id, x1, y1, x2, y2):
+        """ Insert one segment, return its new guid.
         """
-        if tolerance < self.tolerance:
-            raise Exception('Repeat calls to simplify must have increasing tolerances.')
+        self.db.execute("""INSERT INTO segments
+                           (src1_id, src2_id, line_id, x1, y1, x2, y2, removed)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, 0)""",
+                        (src1_id, src2_id, line_id, x1, y1, x2, y2))
         
-        self.tolerance = tolerance
+        return self.db.lastrowid
+    
+    def insert_many(self, rows):
+        """ Insert a list of (guid, src1_id, src2_id, line_id, x1, y1, x2, y2)
+            segments, where each guid is one more than the last in the table.
+        """
+        self.db.executemany("""INSERT INTO segments
+                               (guid, src1_id, src2_id, line_id, x1, y1, x2, y2, removed)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)""", rows)
+    
+    def count(self):
+        """ Return the number of remaining segments.
+        """
+        return self.db.execute('SELECT COUNT(*) FROM segments WHERE removed=0').fetchone()[0]
+    
+    def count_lines(self):
+        """ Return the number of lines with remaining segments.
+        """
+        return self.db.execute('SELECT COUNT(DISTINCT line_id) FROM segments WHERE removed=0').fetchone()[0]
     
+    def line_ids(self):
+        """ Return a list of line_ids with remaining segments, longest first.
+        """
         q = 'SELECT line_id, COUNT(guid) AS guids FROM segments WHERE removed=0 GROUP BY line_id order by guids DESC'
-        line_ids = [line_id for (line_id, count) in self.db.execute(q)]
-        
-        stable_lines = set()
-        
-        while True:
-        
-            was = self.db.execute('SELECT COUNT(*) FROM segments WHERE removed=0').fetchone()[0]
-            
-            preserved, popped = set(), False
-            
-            for line_id in line_ids:
-            
-                if line_id in stable_lines:
-                    continue
-                
-                # For each coordinate that forms the apex of a two-segment
-                # triangle, find the area of that triangle and put it into a list
-                # along with the segment identifier and the resulting line if the
-                # triangle were flattened, ordered from smallest to largest.
-            
-                rows = self.db.execute("""SELECT guid, x1, y1, x2, y2
-                                          FROM segments
-                                          WHERE line_id = ?
-                                          AND removed = 0
-                                          ORDER BY guid""",
-                                             (line_id, ))
-                
-                segs = [(guid, (x1, y1), (x2, y2)) for (guid, x1, y1, x2, y2) in rows]
-                triples = [(segs[i][0], segs[i+1][0], segs[i][1], segs[i][2], segs[i+1][2]) for i in range(len(segs) - 1)]
-                triangles = [(guid1, guid2, Polygon([c1, c2, c3, c1]), c1, c3) for (guid1, guid2, c1, c2, c3) in triples]
-                areas = sorted( [(triangle.area, guid1, guid2, c1, c3) for (guid1, guid2, triangle, c1, c3) in triangles] )
-                
-                min_area = self.tolerance ** 2
-                
-                if not areas or areas[0][0] > min_area:
-                    # there's nothing to be done
-                    stable_lines.add(line_id)
-                    
-                    if verbose:
-                        stderr.write('-')
-                    continue
-                
-                # Reduce any segments that makes a triangle whose area is below
-                # the minimum threshold, starting with the smallest and working up.
-                # Mark segments to be preserved until the next iteration.
-                
-                for (area, guid1, guid2, ca, cb) in areas:
-                    if area > min_area:
-                        # there won't be any more points to remove.
-                        break
-                    
-                    if guid1 in preserved or guid2 in preserved:
-                        # the current segment is too close to a previously-preserved one.
-                        continue
-            
-                    # Check the resulting flattened line against the rest
-                    # any of the original shapefile, to determine if it would
-                    # cross any existing line segment.
-                    
-                    (x1, y1), (x2, y2) = ca, cb
-                    new_line = self.memo_line(x1, y1, x2, y2)
-            
-                    old_guids = self.rtree.intersection(bbox(x1, y1, x2, y2))
-                    old_rows = self.db.execute('SELECT x1, y1, x2, y2 FROM segments WHERE guid IN (%s) AND removed=0' % ','.join(map(str, old_guids)))
-                    old_lines = [self.memo_line(x1, y1, x2, y2) for (x1, y1, x2, y2) in old_rows]
-                    
-                    if True in [new_line.crosses(old_line) for old_line in old_lines]:
-                        if verbose:
-                            stderr.write('x%d' % line_id)
-                        continue
-                    
-                    preserved.add(guid1)
-                    preserved.add(guid2)
-                    
-                    popped = True
-                    
-                    x1, y1, x2, y2 = ca[0], ca[1], cb[0], cb[1]
-            
-                    self.db.execute('UPDATE segments SET removed=1 WHERE guid=%d' % guid2)
-                    self.db.execute('UPDATE segments SET x1=?, y1=?, x2=?, y2=? WHERE guid=?',
-                                          (x1, y1, x2, y2, guid1))
-            
-                    self.rtree.add(guid1, bbox(x1, y1, x2, y2))
-                
-                if verbose:
-                    stderr.write('.')
-            
-            if verbose:
-                print >> stderr, ' reduced from', was, 'to',
-                print >> stderr, self.db.execute('SELECT COUNT(guid) FROM segments WHERE removed=0').fetchone()[0],
-            
-            self.rtree = Rtree()
-            
-            for (guid, x1, y1, x2, y2) in self.db.execute('SELECT guid, x1, y1, x2, y2 FROM segments WHERE removed=0'):
-                self.rtree.add(guid1, bbox(x1, y1, x2, y2))
-                
-            if verbose:
-                print >> stderr, '.'
+        return [line_id for (line_id, count) in self.db.execute(q)]
     
-            if not popped:
-                break
-
-def load(filename, verbose=False):
-    """ Load an OGR data source, return a new Datasource instance.
-    """
-    if verbose:
-        print >> stderr, 'Making data source...'
-
-    datasource = make_datasource(filename)
+    def line_segments(self, line_id):
+        """ Return a list of remaining (guid, x1, y1, x2, y2) for a line, in order.
+        """
+        return self.db.execute("""SELECT guid, x1, y1, x2, y2
+                                  FROM segments
+                                  WHERE line_id = ?
+                                  AND removed = 0
+                                  ORDER BY guid""",
+                               (line_id, )).fetchall()
     
-    if verbose:
-        print >> stderr, 'Making shared borders...'
-
-    shared_borders = populate_shared_segments_by_combination(datasource, verbose)
+    def live_segments(self):
+        """ Generate (guid, x1, y1, x2, y2) for every remaining segment.
+        """
+        return self.db.execute('SELECT guid, x1, y1, x2, y2 FROM segments WHERE removed=0')
     
-    if verbose:
-        print >> stderr, 'Making unshared borders...'
-
-    populate_unshared_segments(datasource, shared_borders, verbose)
+    def coordinates(self, guids):
+        """ Return a list of (x1, y1, x2, y2) for the remaining segments among guids.
+        """
+        return self.db.execute('SELECT x1, y1, x2, y2 FROM segments WHERE guid IN (%s) AND removed=0' % ','.join(map(str, guids))).fetchall()
     
-    return datasource
-
-def make_datasource(filename):
-    """
-    """
-    source = ogr.Open(filename)
-
-    layer = source.GetLayer(0)
-    srs = layer.GetSpatialRef()
-    layer_defn = layer.GetLayerDefn()
-    geom_type = layer_defn.GetGeomType()
+    def update(self, guid, x1, y1, x2, y2):
+        self.db.execute('UPDATE segments SET x1=?, y1=?, x2=?, y2=? WHERE guid=?',
+                        (x1, y1, x2, y2, guid))
     
-    fields = [Field(field_defn.GetNameRef(), field_defn.GetType(), field_defn.GetWidth())
-              for field_defn 
-              in [layer_defn.GetFieldDefn(i) for i in range(layer_defn.GetFieldCount())]]
-
-    values, shapes = [], []
+    def remove(self, guid, area):
+        self.db.execute('UPDATE segments SET removed=1, area=? WHERE guid=?', (area, guid))
     
-    for feature in layer:
-        values.append([feature.GetField(field.name) for field in fields])
-        shapes.append(loads(feature.geometry().ExportToWkb()))
-
-    return Datasource(srs, geom_type, fields, values, shapes)
-
-def linemerge(shape):
-    """ Returns a geometry with lines merged using GEOSLineMerge.
-    """
-    if shape.type != 'MultiLineString':
-        return shape
+    def history(self):
+        """ Generate (line_id, src1_id, src2_id, x1, y1, x2, y2, removed, area)
+            for every segment ever inserted, ordered by line_id and guid.
+        """
+        return self.db.execute("""SELECT line_id, src1_id, src2_id,
+                                         x1, y1, x2, y2, removed, area
+                                  FROM segments ORDER BY line_id, guid""")
     
-    # copied from shapely.ops.linemerge at http://github.com/sgillies/shapely
-    result = lgeos.GEOSLineMerge(shape._geom)
-    return geom_factory(result)
-
-def populate_shared_segments_by_combination(datasource, verbose=False):
-    """
-    """
-    shared = [[] for i in datasource._indexes()]
-    comparison, comparisons = 0, len(datasource._indexes())**2 / 2
+    def rows(self):
+        """ Return a list of every segment as a complete row, ordered by guid.
+        """
+        return self.db.execute("""SELECT guid, src1_id, src2_id, line_id,
+                                         x1, y1, x2, y2, removed, area
+                                  FROM segments ORDER BY guid""").fetchall()
     
-    for (i, j) in combinations(datasource._indexes(), 2):
+    def columns(self):
+        """ Return (src1, src2, line, coords, removed, area) arrays in guid order,
+            in the layout of ArraySegments.
+        """
+        return columns_from_rows(self.rows(), self.coord_type)
     
-        shape1 = datasource.shapes[i]
-        shape2 = datasource.shapes[j]
-        
-        if shape1.intersects(shape2):
-            if verbose:
-                print >> stderr, '%.2f%% -' % (100. * comparison/comparisons),
-                print >> stderr, 'features %d and %d:' % (i, j),
-            
-            border = linemerge(shape1.intersection(shape2))
-            
-            geoms = hasattr(border, 'geoms') and border.geoms or [border]
-            
-            for geom in geoms:
-                try:
-                    line_id = datasource.rtree.count(datasource.rtree.get_bounds())
-                except RTreeError:
-                    line_id = 0
+    def load_columns(self, src1, src2, line, coords, removed, area):
+        """ Insert every segment from arrays in the layout of columns().
+        """
+        rows = zip(src1.tolist(), src2.tolist(), line.tolist(), coords.tolist(), removed.tolist(), area.tolist())
         
-                coords = list(geom.coords)
-                segments = [coords[k:k+2] for k in range(len(coords) - 1)]
-                
-                for ((x1, y1), (x2, y2)) in segments:
-                    datasource.db.execute("""INSERT INTO segments
-                                             (src1_id, src2_id, line_id, x1, y1, x2, y2, removed)
-                                             VALUES (?, ?, ?, ?, ?, ?, ?, 0)""",
-                                          (i, j, line_id, x1, y1, x2, y2))
-                    
-                    bbox = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
-                    datasource.rtree.add(datasource.db.lastrowid, bbox)
+        self.db.executemany("""INSERT INTO segments
+                               (src1_id, src2_id, line_id, x1, y1, x2, y2, removed, area)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                            ((src1_id, src2_id if src2_id >= 0 else None, line_id, x1, y1, x2, y2,
+                              int(removed), area if area == area else None)
+                             for (src1_id, src2_id, line_id, (x1, y1, x2, y2), removed, area) in rows))
 
-                if verbose:
-                    print >> stderr, len(coords), '-',
-            
-            shared[i].append(border)
-            shared[j].append(border)
-            
-            if verbose:
-                print >> stderr, border.type
+class ArraySegments:
+    """ Segments stored in growable NumPy arrays, one per column.
     
-        comparison += 1
-
-    return shared
-
-def populate_shared_segments_by_rtree(datasource, verbose=False):
-    """
+        Guids are positions in the arrays plus one, like SQLite rowids.
+        A missing src2_id is stored as -1 and a missing area as NaN.
+        Segments for each line are found through an index built on demand,
+        and thrown out whenever a new segment is inserted. Coordinates are
+        kept in an array of coord_type, which is an integer type for a
+        quantized Datasource.
     """
-    rtree = Rtree()
-    indexes = datasource._indexes()
+    def __init__(self, capacity=1024, coord_type=numpy.float64):
+        self.length = 0
+        self.src1 = numpy.empty(capacity, numpy.int64)
+        self.src2 = numpy.empty(capacity, numpy.int64)
+        self.line = numpy.empty(capacity, numpy.int64)
+        self.coords = numpy.empty((capacity, 4), coord_type)
+        self.removed = numpy.empty(capacity, numpy.bool_)
+        self.area = numpy.empty(capacity, numpy.float64)
+        
+        self._lines = None
     
-    for i in indexes:
-        xmin, ymin, xmax, ymax = datasource.shapes[i].bounds
+    def _reserve(self, count):
+        """ Make sure there is room for count more segments.
+        """
+        capacity = len(self.line)
         
-        xbuf = (xmax - xmin) * .001
-        ybuf = (ymax - ymin) * .001
+        if self.length + count <= capacity:
+            return
         
-        bounds = (xmin-xbuf, ymin-ybuf, xmax+xbuf, ymax+ybuf)
+        while capacity < self.length + count:
+            capacity *= 2
         
-        rtree.add(i, bounds)
+        for name in ('src1', 'src2', 'line', 'coords', 'removed', 'area'):
+            old = getattr(self, name)
+            new = numpy.empty((capacity, ) + old.shape[1:], old.dtype)
+            new[:self.length] = old[:self.length]
+            setattr(self, name, new)
     
-    shared = [[] for i in indexes]
-    
-    for i in indexes:
-        for j in rtree.intersection(datasource.shapes[i].bounds):
-            
-            if i >= j:
-                continue
-            
-            shape1 = datasource.shapes[i]
-            shape2 = datasource.shapes[j]
-            
-            if not shape1.intersects(shape2):
-                continue
-            
-            if verbose:
-                print >> stderr, 'Features %d and %d:' % (i, j), 'of', len(indexes),
-            
-            border = linemerge(shape1.intersection(shape2))
-            
-            geoms = hasattr(border, 'geoms') and border.geoms or [border]
-            
-            for geom in geoms:
-                try:
-                    line_id = datasource.rtree.count(datasource.rtree.get_bounds())
-                except RTreeError:
-                    line_id = 0
+    def _line_index(self):
+        """ Return a dictionary of line_ids to arrays of positions in guid order.
+        """
+        if self._lines is None:
+            lines = self.line[:self.length]
+            order = numpy.argsort(lines, kind='mergesort')
+            self._lines = group_positions(lines[order], order)
         
-                coords = list(geom.coords)
-                segments = [coords[k:k+2] for k in range(len(coords) - 1)]
-                
-                for ((x1, y1), (x2, y2)) in segments:
-                    datasource.db.execute("""INSERT INTO segments
-                                             (src1_id, src2_id, line_id, x1, y1, x2, y2, removed)
-                                             VALUES (?, ?, ?, ?, ?, ?, ?, 0)""",
-                                          (i, j, line_id, x1, y1, x2, y2))
-                    
-                    bbox = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
-                    datasource.rtree.add(datasource.db.lastrowid, bbox)
-
-                if verbose:
-                    print >> stderr, len(coords), '-',
-            
-            shared[i].append(border)
-            shared[j].append(border)
-            
-            if verbose:
-                print >> stderr, border.type
-
-    return shared
-
-def populate_unshared_segments(datasource, shared, verbose=False):
-    """
-    """
-    for i in datasource._indexes():
+        return self._lines
     
-        boundary = datasource.shapes[i].boundary
+    def insert(self, src1_id, src2_id, line_id, x1, y1, x2, y2):
+        """ Insert one segment, return its new guid.
+        """
+        self._reserve(1)
         
-        for border in shared[i]:
-            boundary = boundary.difference(border)
+        i = self.length
+        self.src1[i] = src1_id
+        self.src2[i] = -1 if src2_id is None else src2_id
+        self.line[i] = line_id
+        self.coords[i] = x1, y1, x2, y2
+        self.removed[i] = False
+        self.area[i] = numpy.nan
         
-        if verbose:
-            print >> stderr, 'Feature %d:' % i,
+        self.length += 1
+        self._lines = None
+        
+        return self.length
     
-        geoms = hasattr(boundary, 'geoms') and boundary.geoms or [boundary]
-        geoms = [geom for geom in geoms if hasattr(geom, 'coords')]
+    def insert_many(self, rows):
+        """ Insert a list of (guid, src1_id, src2_id, line_id, x1, y1, x2, y2)
+            segments, where each guid is one more than the last in the store.
+        """
+        if not rows:
+            return
         
-        for geom in geoms:
-            try:
-                line_id = datasource.rtree.count(datasource.rtree.get_bounds())
-            except RTreeError:
-                line_id = 0
+        guids, src1, src2, line, x1, y1, x2, y2 = zip(*rows)
+        
+        if guids[0] != self.length + 1:
+            raise Exception('Expected guid %d, not %d' % (self.length + 1, guids[0]))
+        
+        self._reserve(len(rows))
+        n, m = self.length, self.length + len(rows)
+        
+        self.src1[n:m] = src1
+        self.src2[n:m] = [-1 if src2_id is None else src2_id for src2_id in src2]
+        self.line[n:m] = line
+        self.coords[n:m] = numpy.array((x1, y1, x2, y2), self.coords.dtype).T
+        self.removed[n:m] = False
+        self.area[n:m] = numpy.nan
+        
+        self.length = m
+        self._lines = None
     
-            coords = list(geom.coords)
-            segments = [coords[k:k+2] for k in range(len(coords) - 1)]
-            
-            for ((x1, y1), (x2, y2)) in segments:
-                datasource.db.execute("""INSERT INTO segments
-                                         (src1_id, line_id, x1, y1, x2, y2, removed)
-                                         VALUES (?, ?, ?, ?, ?, ?, 0)""",
-                                      (i, line_id, x1, y1, x2, y2))
-                
-                bbox = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
-                datasource.rtree.add(datasource.db.lastrowid, bbox)
+    def count(self):
+        """ Return the number of remaining segments.
+        """
+        return int(self.length - self.removed[:self.length].sum())
     
-            if verbose:
-                print >> stderr, len(coords), '-',
+    def count_lines(self):
+        """ Return the number of lines with remaining segments.
+        """
+        live = ~self.removed[:self.length]
+        return len(numpy.unique(self.line[:self.length][live]))
     
-        if verbose:
-            print >> stderr, boundary.type
-
-def save(datasource, filename):
-    """ Save a Datasource instance to a named OGR datasource.
-    """
-    ext = splitext(filename)[1]
+    def line_ids(self):
+        """ Return a list of line_ids with remaining segments, longest first.
+        """
+        live = ~self.removed[:self.length]
+        
+        if not live.any():
+            return []
+        
+        counts = numpy.bincount(self.line[:self.length][live])
+        order = numpy.argsort(-counts, kind='mergesort')
+        
+        return [int(line_id) for line_id in order if counts[line_id]]
+    
+    def line_segments(self, line_id):
+        """ Return a list of remaining (guid, x1, y1, x2, y2) for a line, in order.
+        """
+        positions = self._line_index().get(line_id, [])
+        positions = [int(i) for i in positions if not self.removed[i]]
+        
+        return [(i + 1, ) + tuple(coords) for (i, coords) in zip(positions, self.coords[positions].tolist())]
+    
+    def live_segments(self):
+        """ Generate (guid, x1, y1, x2, y2) for every remaining segment.
+        """
+        positions = numpy.nonzero(~self.removed[:self.length])[0]
+        
+        for (i, coords) in zip(positions.tolist(), self.coords[positions].tolist()):
+            yield (i + 1, ) + tuple(coords)
+    
+    def coordinates(self, guids):
+        """ Return a list of (x1, y1, x2, y2) for the remaining segments among guids.
+        """
+        positions = numpy.fromiter(guids, numpy.int64) - 1
+        positions = positions[~self.removed[positions]]
+        
+        return map(tuple, self.coords[positions].tolist())
+    
+    def update(self, guid, x1, y1, x2, y2):
+        self.coords[guid - 1] = x1, y1, x2, y2
+    
+    def remove(self, guid, area):
+        self.removed[guid - 1] = True
+        self.area[guid - 1] = area
+    
+    def history(self):
+        """ Generate (line_id, src1_id, src2_id, x1, y1, x2, y2, removed, area)
+            for every segment ever inserted, ordered by line_id and guid.
+        """
+        n = self.length
+        positions = numpy.argsort(self.line[:n], kind='mergesort')
+        
+        columns = (self.line[positions].tolist(), self.src1[positions].tolist(), self.src2[positions].tolist(),
+                   self.coords[positions].tolist(), self.removed[positions].tolist(), self.area[positions].tolist())
+        
+        for (line_id, src1_id, src2_id, (x1, y1, x2, y2), removed, area) in zip(*columns):
+            yield (line_id, src1_id, src2_id if src2_id >= 0 else None,
+                   x1, y1, x2, y2, int(removed), area if area == area else None)
+    
+    def rows(self):
+        """ Return a list of every segment as a complete row, ordered by guid.
+        """
+        n = self.length
+        
+        return [(i + 1, src1_id, src2_id if src2_id >= 0 else None, line_id,
+                 x1, y1, x2, y2, int(removed), area if area == area else None)
+                for (i, src1_id, src2_id, line_id, (x1, y1, x2, y2), removed, area)
+                in zip(range(n), self.src1[:n].tolist(), self.src2[:n].tolist(), self.line[:n].tolist(),
+                       self.coords[:n].tolist(), self.removed[:n].tolist(), self.area[:n].tolist())]
+    
+    def columns(self):
+        """ Return (src1, src2, line, coords, removed, area) arrays in guid order.
+        """
+        n = self.length
+        return self.src1[:n], self.src2[:n], self.line[:n], self.coords[:n], self.removed[:n], self.area[:n]
+    
+    def load_columns(self, src1, src2, line, coords, removed, area):
+        """ Take on arrays in the layout of columns(), which may be memory-mapped.
+        
+            An empty store uses the arrays as they are, so memory maps opened
+            copy-on-write are only read from disk as needed.
+        """
+        if self.length:
+            self._reserve(len(line))
+            n, m = self.length, self.length + len(line)
+            self.src1[n:m], self.src2[n:m], self.line[n:m] = src1, src2, line
+            self.coords[n:m], self.removed[n:m], self.area[n:m] = coords, removed, area
+        
+        else:
+            self.src1, self.src2, self.line = src1, src2, line
+            self.coords, self.removed, self.area = coords, removed, area
+        
+        self.length += len(line)
+        self._lines = None
+
+stores = {'sqlite': SQLiteSegments, 'array': ArraySegments}
+
+class LineSegments:
+    """ Segments of one line and the fixed segments around it.
+    
+        Implements the parts of the segment store API that collapse_lines()
+        uses, so a line can be simplified in another process. Changes are
+        kept in log as (guid, area, None) for a removal or (guid, None,
+        coords) for an update, to be applied later to the real store.
+    """
+    def __init__(self, rows, neighbors):
+        """ Rows are (guid, x1, y1, x2, y2) from line_segments(), neighbors are (x1, y1, x2, y2).
+        
+            Neighbors are given new guids after the highest one in rows.
+        """
+        first = max([guid for (guid, x1, y1, x2, y2) in rows]) + 1
+        
+        self.rows, self.log = rows, []
+        self.coords = dict([(guid, (x1, y1, x2, y2)) for (guid, x1, y1, x2, y2) in rows])
+        self.coords.update(zip(range(first, first + len(neighbors)), map(tuple, neighbors)))
+    
+    def line_segments(self, line_id):
+        return self.rows
+    
+    def coordinates(self, guids):
+        return [self.coords[guid] for guid in guids if guid in self.coords]
+    
+    def update(self, guid, x1, y1, x2, y2):
+        self.coords[guid] = (x1, y1, x2, y2)
+        self.log.append((guid, None, (x1, y1, x2, y2)))
+    
+    def remove(self, guid, area):
+        del self.coords[guid]
+        self.log.append((guid, area, None))
+
+class Datasource:
+    """ Store an exploded representation of a data source, so it can be simplified.
+    """
+    def __init__(self, srs, geom_type, fields, values, shapes, store='sqlite', memo_size=65536, areas=None, grid=None):
+        """ Use load() to call this constructor.
+        
+            Store names the segment store implementation, one of the keys in stores.
+            Memo_size limits the number of line strings kept by memo_line.
+            Areas are taken from shapes unless given.
+            If a Grid is given, shapes and segments are in its cells.
+        """
+        self.srs = srs
+        self.fields = fields
+        self.geom_type = geom_type
+        self.values = values
+        self.shapes = shapes
+        
+        # kept apart from shapes so save() can tell when small features disappear
+        self.areas = areas if areas is not None else [shape.area for shape in (shapes or [])]
+
+        # this will be changed later
+        self.tolerance = 0
+        
+        # lowest tolerance that save() can still produce from recorded areas
+        self.rank_floor = 0
+        
+        # tolerances and areas stay in map units, and are scaled to cells as needed
+        self.grid = grid
+        
+        # indexes of features snapped to nothing by the grid, which save() skips
+        self.collapsed = set()
+        
+        self.segments = stores[store](coord_type=grid.coord_type if grid else numpy.float64)
+        self.rtree = Rtree()
+        
+        # segments added by insert_line() and waiting for flush_lines()
+        self.pending, self.next_guid = [], 1
+        
+        # line_ids that simplify() and rank() must leave alone
+        self.pinned = set()
+        self.memo_line = make_memo_line(memo_size)
+        
+        # counters and timings from the latest run of each phase
+        self.stats = dict(load={})
+        
+        # source layers, and owners beyond src1 and src2 of lines shared by more than two features
+        self.layers = [Layer(None, srs, geom_type, fields, 0, len(values))]
+        self.owners = {}
+
+    def _indexes(self):
+        return range(len(self.values))
+    
+    def _area(self, tolerance):
+        """ Return the square of a tolerance, in cells if there's a grid.
+        """
+        return (tolerance / self.grid.size) ** 2 if self.grid else tolerance ** 2
+    
+    def simplify(self, tolerance, verbose=False, workers=None):
+        """ Simplify the polygonal linework.
+        
+            This method can be called multiple times, but the process is
+            destructive so it must be called with progressively increasing
+            tolerance values.
+            
+            If workers is given, lines are simplified in a process pool,
+            with the same results as simplifying them in one process.
+            
+            Returns a dictionary of counters and timings, also kept in stats.
+        """
+        if tolerance < self.tolerance:
+            raise Exception('Repeat calls to simplify must have increasing tolerances.')
+        
+        start, floor_area, self.tolerance = time(), self._area(self.tolerance), tolerance
+        
+        line_ids = [line_id for line_id in self.segments.line_ids() if line_id not in self.pinned]
+        was = self.segments.count()
+        
+        stats = self.stats['simplify'] = dict(tolerance=tolerance, lines=len(line_ids), segments_before=was, passes=1)
+        
+        if workers:
+            rejected = self._collapse_in_pool(line_ids, self._area(tolerance), floor_area, workers, verbose, stats)
+        
+        else:
+            rejected = self._collapse_each(line_ids, self._area(tolerance), floor_area, verbose, stats)
+        
+        # A vertex rejected for crossing another line can be freed when that
+        # line is collapsed later, so lines with rejections are tried again
+        # in turn until a round removes nothing.
+        
+        while rejected:
+            count = self.segments.count()
+            tally(stats, passes=1)
+            rejected = self._collapse_each(rejected, self._area(tolerance), floor_area, verbose, stats)
+            
+            if self.segments.count() == count:
+                break
+        
+        stats.update(segments_after=self.segments.count(), seconds=time() - start)
+        
+        if verbose:
+            print >> stderr, ' reduced from', was, 'to',
+            print >> stderr, stats['segments_after']
+        
+        # lines were simplified one at a time, so areas recorded here
+        # can't be used to recover intermediate tolerances.
+        self.rank_floor = tolerance
+        
+        return stats
+    
+    def rank(self, tolerance, verbose=False):
+        """ Rank vertices by importance up to a maximum tolerance.
+        
+            Vertices on all lines are collapsed together in order of
+            increasing area, and the area of each one is recorded when it is
+            removed. Afterwards, save() can produce any tolerance between
+            this one and the previous simplify() tolerance, in any order.
+            
+            Returns a dictionary of counters and timings, also kept in stats.
+        """
+        if tolerance < self.tolerance:
+            raise Exception('Repeat calls to rank must have increasing tolerances.')
+        
+        start, floor_area, self.tolerance = time(), self._area(self.tolerance), tolerance
+        
+        line_ids = [line_id for line_id in self.segments.line_ids() if line_id not in self.pinned]
+        was = self.segments.count()
+        
+        stats = self.stats['rank'] = dict(tolerance=tolerance, lines=len(line_ids), segments_before=was, passes=1)
+        
+        self._collapse_lines(line_ids, self._area(tolerance), floor_area, verbose, stats)
+        
+        stats.update(segments_after=self.segments.count(), seconds=time() - start)
+        
+        if verbose:
+            print >> stderr, 'Ranked', was - stats['segments_after'],
+            print >> stderr, 'of', was, 'vertices.'
+        
+        return stats
+    
+    def _collapse_lines(self, line_ids, min_area, floor_area=0, verbose=False, stats=None):
+        """ Remove every vertex on the given lines whose effective area is below min_area.
+        
+            See collapse_lines() for details.
+        """
+        return collapse_lines(self.segments, self.rtree, line_ids, min_area, floor_area, verbose, stats)
+    
+    def _collapse_each(self, line_ids, min_area, floor_area=0, verbose=False, stats=None):
+        """ Collapse lines one at a time in order.
+        
+            Returns a list of line ids with vertices rejected for crossings.
+        """
+        rejected = []
+        
+        for line_id in line_ids:
+            counts = {}
+            self._collapse_lines([line_id], min_area, floor_area, verbose, counts)
+            
+            if counts.get('rejected'):
+                rejected.append(line_id)
+            
+            if stats is not None:
+                tally(stats, **counts)
+            
+            if verbose:
+                stderr.write('.')
+        
+        return rejected
+    
+    def _collapse_in_pool(self, line_ids, min_area, floor_area, workers, verbose=False, stats=None):
+        """ Collapse lines one at a time in order, using a pool of workers.
+        
+            A line is only ever checked for crossings inside its own bounding
+            box, so lines with boxes that don't intersect can be collapsed at
+            the same time. Lines are grouped by independent_batches(), and
+            every line in a batch is sent to a worker along with the segments
+            around it. Changes come back as a log to be applied here, so the
+            results are the same as collapsing each line in turn.
+            
+            Returns a list of line ids with vertices rejected for crossings.
+        """
+        boxes = [line_bbox(self.segments.line_segments(line_id)) for line_id in line_ids]
+        batches = independent_batches(boxes)
+        
+        if stats is not None:
+            tally(stats, batches=len(batches))
+        
+        pool, rejected = Pool(workers), []
+        
+        for batch in batches:
+            # Tasks are all built before any changes are applied, because
+            # the pool reads them from another thread. None of them overlap.
+            tasks, task_ids = [], []
+            
+            for i in batch:
+                rows = self.segments.line_segments(line_ids[i])
+                
+                if len(rows) < 2:
+                    # nothing to collapse, so no need to send it anywhere.
+                    self._collapse_lines([line_ids[i]], min_area, floor_area, verbose, stats)
+                    continue
+                
+                own = set([guid for (guid, x1, y1, x2, y2) in rows])
+                guids = [guid for guid in self.rtree.intersection(boxes[i]) if guid not in own]
+                tasks.append((rows, self.segments.coordinates(guids), min_area, floor_area))
+                task_ids.append(line_ids[i])
+            
+            chunksize = len(tasks) / (workers * 4) + 1
+            results = pool.imap(_pooled_collapse_line, tasks, chunksize)
+            
+            for (line_id, (rows, log, counts)) in izip(task_ids, results):
+                self._apply_collapses(rows, log)
+                
+                if counts.get('rejected'):
+                    rejected.append(line_id)
+                
+                if stats is not None:
+                    tally(stats, **counts)
+                
+                if verbose:
+                    stderr.write('.')
+        
+        pool.close()
+        pool.join()
+        
+        # batches finish out of order, so rejections are put back in line order.
+        positions = dict(zip(line_ids, range(len(line_ids))))
+        
+        return sorted(rejected, key=positions.get)
+    
+    def _apply_collapses(self, rows, log):
+        """ Apply a log of changes from a LineSegments to the store and spatial index.
+        """
+        coords = dict([(guid, (x1, y1, x2, y2)) for (guid, x1, y1, x2, y2) in rows])
+        
+        for (guid, area, new_coords) in log:
+            self.rtree.delete(guid, bbox(*coords[guid]))
+            
+            if new_coords is None:
+                self.segments.remove(guid, area)
+                del coords[guid]
+            
+            else:
+                self.segments.update(guid, *new_coords)
+                self.rtree.add(guid, bbox(*new_coords))
+                coords[guid] = new_coords
+
+    def lines(self, tolerance=None):
+        """ Generate (line_id, src1_id, src2_id, points) for every line.
+        
+            With no tolerance, points are the current simplified vertices.
+            Otherwise, vertices are kept if they were never removed or were
+            removed by rank() at an area above the square of the tolerance.
+            
+            Points are in map units, even when segments are stored in cells.
+        """
+        if tolerance is None:
+            min_area = None
+        
+        elif tolerance < self.rank_floor or tolerance > self.tolerance:
+            raise Exception('Tolerance %s is outside the ranked range of %s to %s.' % (tolerance, self.rank_floor, self.tolerance))
+        
+        else:
+            min_area = self._area(tolerance)
+        
+        # Segment start points are never moved by a collapse, and neither is
+        # the end point of a line's last segment, so the original vertices
+        # can be read back in order and filtered by their recorded areas.
+        
+        for (line_id, rows) in groupby(self.segments.history(), itemgetter(0)):
+            points = []
+            
+            for (line_id, src1_id, src2_id, x1, y1, x2, y2, removed, area) in rows:
+                if not removed or (min_area is not None and area > min_area):
+                    points.append((x1, y1))
+            
+            points.append((x2, y2))
+            
+            if self.grid is not None:
+                points = self.grid.points(points)
+            
+            yield line_id, src1_id, src2_id, points
+    
+    def snapshot(self, tolerance=None):
+        """ Return a Snapshot of the lines at a tolerance, or as currently simplified.
+        """
+        return Snapshot(self, tolerance)
+
+class Snapshot:
+    """ Frozen copy of the lines of a Datasource, which save() accepts in its place.
+    
+        Snapshots can be pickled, so one can be saved in another process
+        while the Datasource it came from goes on being simplified.
+    """
+    def __init__(self, datasource, tolerance=None):
+        self.layers = datasource.layers
+        self.values = datasource.values
+        self.areas = datasource.areas
+        self.owners = dict(datasource.owners)
+        self.grid = datasource.grid
+        self.collapsed = datasource.collapsed
+        self.tolerance = datasource.tolerance if tolerance is None else tolerance
+        self.stats = {}
+        
+        self.memo_size = datasource.memo_line.size
+        self.memo_line = make_memo_line(self.memo_size)
+        
+        self._lines = list(datasource.lines(tolerance))
+    
+    def _indexes(self):
+        return range(len(self.values))
+    
+    def lines(self, tolerance=None):
+        """ Generate (line_id, src1_id, src2_id, points) for every line, like Datasource.lines().
+        """
+        if tolerance is not None and tolerance != self.tolerance:
+            raise Exception('Snapshot was taken at tolerance %s, not %s.' % (self.tolerance, tolerance))
+        
+        return iter(self._lines)
+    
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['memo_line']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memo_line = make_memo_line(self.memo_size)
+
+def load(filename, verbose=False, pairing='rtree', workers=None, store='sqlite', memo_size=65536, builder='overlay', fids=None, quantize=None):
+    """ Load an OGR data source, return a new Datasource instance.
+    
+        Builder is "overlay" to find borders by intersecting pairs of features,
+        or "arcs" to find them by matching vertices with populate_arcs().
+        
+        Pairing names the strategy used to find features with shared borders,
+        one of the keys in pairings. Both give identical segments, but
+        "combination" keeps every shape parsed in memory while it runs.
+        
+        If workers is given, border geometry is computed in a process pool
+        of that size, with results identical to a serial run.
+        
+        Store names the segment store implementation, one of the keys in stores.
+        Memo_size limits the number of line strings kept by memo_line.
+        
+        If fids is given, only those features are loaded, in that order.
+        
+        If quantize is given, coordinates are snapped to a Grid of that
+        size in map units before borders are found, so vertices closer than
+        that come together and near-coincident borders match exactly.
+        Segments are then stored as integers, and tolerances are still
+        given in map units. Snapping is done once when reading features,
+        with results kept in datasource.grid. Features smaller than a cell
+        can snap to nothing, and are listed in datasource.collapsed and
+        skipped when saving.
+        
+        Filename can also be a (filename, layer) pair naming a layer other
+        than the first, or a list of filenames and pairs to load into one
+        Datasource with shared borders. Each becomes one of datasource.layers
+        and can be saved separately. Layers that overlap each other, such as
+        states and the counties in them, must use the arcs builder.
+        
+        Field values are read from the source again when saving, and source
+        shapes are released once borders are found, so the result can be
+        simplified and saved but not loaded into further.
+        
+        Counters and timings are kept in the stats['load'] dictionary.
+    """
+    if pairing not in pairings:
+        raise Exception('Unknown pairing "%s" - try one of %s' % (pairing, ', '.join(sorted(pairings))))
+    
+    if builder not in ('overlay', 'arcs'):
+        raise Exception('Unknown builder "%s" - try overlay or arcs' % builder)
+    
+    if verbose:
+        print >> stderr, 'Making data source...'
+
+    start = time()
+    
+    # every pair means reading every later shape for each one, which would
+    # cycle through any cache smaller than the whole set of shapes.
+    shape_cache = None if pairing == 'combination' else 1024
+    datasource = make_datasource(filename, store, memo_size, fids, shape_cache, quantize)
+    
+    stats = datasource.stats['load']
+    stats.update(builder=builder, features=len(datasource.values), read_seconds=time() - start, quantize=quantize)
+    
+    if builder == 'arcs':
+        if verbose:
+            print >> stderr, 'Making arcs...'
+        
+        populate_arcs(datasource, verbose)
+    
+    else:
+        if verbose:
+            print >> stderr, 'Making shared borders...'
+    
+        pool = workers and start_pool(datasource, workers) or None
+        
+        try:
+            shared_borders = pairings[pairing](datasource, verbose, pool)
+            
+            if verbose:
+                print >> stderr, 'Making unshared borders...'
+        
+            populate_unshared_segments(datasource, shared_borders, verbose, pool)
+        
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    
+    flush_lines(datasource)
+    stats['seconds'] = time() - start
+    
+    datasource.shapes = None
+    return datasource
+
+def make_datasource(filename, store='sqlite', memo_size=65536, fids=None, shape_cache=1024, quantize=None):
+    """ Read OGR data sources into a new Datasource instance with no segments.
+    
+        Filename is anything accepted by layer_sources(). If fids is given,
+        only those features are read from a single layer, in that order.
+        
+        Features are streamed from each layer, keeping only feature ids, areas
+        and WKB geometry. Field values are read later through SourceValues,
+        and up to shape_cache shapes are kept parsed by WKBShapes.
+        
+        If quantize is given, shapes are snapped to a grid of that size
+        covering the extent of every layer, with nearby vertices brought
+        together by Grid.clusters() and segments bent through the cells of
+        vertices they pass by HotPixels. Areas are kept from the original
+        shapes.
+    """
+    sources, layers = [], []
+    source_ids, source_fids, wkbs, areas = array('H'), array('l'), [], []
+    
+    if fids is not None and len(layer_sources(filename)) > 1:
+        raise Exception('Feature ids can only be given for a single layer')
+    
+    if quantize:
+        # whole layers are measured even with fids, so partitions share a grid.
+        extents = [ogr.Open(name).GetLayer(layer_key).GetExtent() for (name, layer_key) in layer_sources(filename)]
+        grid = make_grid(quantize, extents)
+    
+    else:
+        grid = None
+    
+    for (k, (name, layer_key)) in enumerate(layer_sources(filename)):
+        source = ogr.Open(name)
+        layer = source.GetLayer(layer_key)
+        srs, geom_type, fields = layer_schema(layer)
+        
+        start = len(wkbs)
+        features = layer if fids is None else (layer.GetFeature(fid) for fid in fids)
+        
+        for feature in features:
+            geometry = feature.geometry()
+            source_ids.append(k)
+            source_fids.append(feature.GetFID())
+            wkbs.append(geometry.ExportToWkb())
+            areas.append(geometry.GetArea())
+        
+        # layers are named for their files unless a layer was asked for.
+        layer_name = splitext(basename(name))[0] if layer_key == 0 else layer.GetName()
+        
+        if layer_name in [other.name for other in layers]:
+            layer_name = '%s-%d' % (layer_name, k)
+        
+        sources.append((name, layer_key, fields))
+        layers.append(Layer(layer_name, srs, geom_type, fields, start, len(wkbs) - start))
+    
+    if grid is not None:
+        collapsed = snap_wkbs(grid, wkbs)
+    
+    values = SourceValues(sources, source_ids, source_fids)
+    shapes = WKBShapes(wkbs, shape_cache)
+
+    datasource = Datasource(layers[0].srs, layers[0].geom_type, layers[0].fields, values, shapes, store, memo_size, areas, grid)
+    datasource.layers = layers
+    
+    if grid is not None:
+        # features smaller than a cell are left empty, and skipped by save().
+        datasource.collapsed = collapsed
+        tally(datasource.stats['load'], collapsed_features=len(collapsed))
+    
+    return datasource
+
+def point_groups(points, distance):
+    """ Return a list of groups of points joined by being closer than distance.
+    
+        Groups are found with union-find over buckets of the distance's size,
+        and points with no other point nearby are left out.
+    """
+    buckets, parents, groups = {}, {}, {}
+    
+    for point in points:
+        key = int(floor(point[0] / distance)), int(floor(point[1] / distance))
+        buckets.setdefault(key, []).append(point)
+    
+    def root(point):
+        path = []
+        
+        while point in parents:
+            path.append(point)
+            point = parents[point]
+        
+        parents.update([(other, point) for other in path])
+        return point
+    
+    for ((column, row), members) in buckets.items():
+        neighbors = [other for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                     for other in buckets.get((column + dx, row + dy), [])]
+        
+        for point in members:
+            for other in neighbors:
+                if point < other and hypot(point[0] - other[0], point[1] - other[1]) < distance:
+                    first, second = sorted((root(point), root(other)))
+                    
+                    if first != second:
+                        parents[second] = first
+    
+    for point in parents:
+        groups.setdefault(root(point), [root(point)]).append(point)
+    
+    return groups.values()
+
+def winding_number(point, ring):
+    """ Return how many times a ring of points winds counterclockwise around a point.
+    """
+    (x, y), winding = point[:2], 0
+    
+    for ((x1, y1), (x2, y2)) in zip(ring, ring[1:] + ring[:1]):
+        side = (x2 - x1) * (y - y1) - (x - x1) * (y2 - y1)
+        
+        if y1 <= y < y2 and side > 0:
+            winding += 1
+        
+        elif y2 <= y < y1 and side < 0:
+            winding -= 1
+    
+    return winding
+
+def crosses_square(start, end, center, radius):
+    """ Return True if a segment runs through a square around center, not just touching it.
+    """
+    (x1, y1), (x2, y2), (x, y) = start, end, center
+    dx, dy, first, last = x2 - x1, y2 - y1, 0., 1.
+    
+    for (p, q) in ((-dx, x1 - x + radius), (dx, x + radius - x1), (-dy, y1 - y + radius), (dy, y + radius - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        
+        elif p < 0:
+            first = max(first, q / float(p))
+        
+        else:
+            last = min(last, q / float(p))
+    
+    return first < last
+
+def snap_wkbs(grid, wkbs):
+    """ Snap a list of WKB shapes to a grid in place.
+    
+        Shapes are snapped once every vertex has been seen, so clusters
+        come out the same whatever order features were read in.
+        
+        Return a set of indexes of shapes left empty.
+    """
+    points, collapsed = set(), set()
+    
+    for wkb in wkbs:
+        for ring in shape_rings(loads(wkb)):
+            points.update([point[:2] for point in ring])
+    
+    points = list(points)
+    clusters = grid.clusters(points)
+    cells = map(tuple, grid.cells(points).tolist()) if points else []
+    pixels = HotPixels(set([clusters.get(point, cell) for (point, cell) in zip(points, cells)]))
+    
+    for (i, wkb) in enumerate(wkbs):
+        shape = grid.snap(loads(wkb), clusters, pixels)
+        wkbs[i] = dumps(shape)
+        
+        if shape.is_empty:
+            collapsed.add(i)
+    
+    return collapsed
+
+def make_grid(size, extents):
+    """ Return a Grid of cells size map units wide for a list of (xmin, xmax, ymin, ymax)
+        extents from OGR's GetExtent(), using 32-bit cells if they're big enough.
+    """
+    xmin, xmax = min([extent[0] for extent in extents]), max([extent[1] for extent in extents])
+    ymin, ymax = min([extent[2] for extent in extents]), max([extent[3] for extent in extents])
+    
+    size = float(size)
+    column, row = int(numpy.floor(xmin / size)), int(numpy.floor(ymin / size))
+    cells = max(xmax / size - column, ymax / size - row) + 1
+    
+    return Grid(size, column, row, numpy.int32 if cells < 2 ** 31 else numpy.int64)
+
+def layer_sources(filename):
+    """ Return a list of (filename, layer) pairs for a filename, a (filename, layer)
+        pair, or a list of either.
+        
+        Layers are indexes or names, and a bare filename means its first layer.
+    """
+    if type(filename) is list:
+        return [source for name in filename for source in layer_sources(name)]
+    
+    if type(filename) is tuple:
+        return [filename]
+    
+    return [(filename, 0)]
+
+def layer_schema(layer):
+    """ Return srs, geometry type and a list of Fields for an OGR layer.
+    """
+    srs = layer.GetSpatialRef()
+    layer_defn = layer.GetLayerDefn()
+    geom_type = layer_defn.GetGeomType()
+    
+    fields = [Field(field_defn.GetNameRef(), field_defn.GetType(), field_defn.GetWidth())
+              for field_defn 
+              in [layer_defn.GetFieldDefn(i) for i in range(layer_defn.GetFieldCount())]]
+    
+    return srs, geom_type, fields
+
+def linemerge(shape):
+    """ Returns a geometry with lines merged using GEOSLineMerge.
+    """
+    if shape.type != 'MultiLineString':
+        return shape
+    
+    # copied from shapely.ops.linemerge at http://github.com/sgillies/shapely
+    result = lgeos.GEOSLineMerge(shape._geom)
+    return geom_factory(result)
+
+def populate_shared_segments_by_combination(datasource, verbose=False, pool=None):
+    """ Find and insert borders shared by any pair of features.
+    
+        Every pair of features is tested for intersection, which is
+        quadratic in the number of features.
+    """
+    pairs = combinations(datasource._indexes(), 2)
+    
+    return populate_shared_segments(datasource, pairs, verbose, pool)
+
+def populate_shared_segments_by_rtree(datasource, verbose=False, pool=None):
+    """ Like populate_shared_segments_by_combination(), but only test pairs
+        of features whose buffered bounding boxes overlap in a spatial index.
+        
+        Candidates are visited in the same order as combinations() would,
+        so the resulting segments table is identical.
+    """
+    rtree = Rtree()
+    indexes = datasource._indexes()
+    buffered = []
+    
+    for i in indexes:
+        if datasource.shapes[i].is_empty:
+            # nothing left after quantizing, so nothing to share.
+            buffered.append(None)
+            continue
+        
+        xmin, ymin, xmax, ymax = datasource.shapes[i].bounds
+        
+        xbuf = (xmax - xmin) * .001
+        ybuf = (ymax - ymin) * .001
+        
+        bounds = (xmin-xbuf, ymin-ybuf, xmax+xbuf, ymax+ybuf)
+        
+        rtree.add(i, bounds)
+        buffered.append(bounds)
+    
+    pairs = ((i, j) for i in indexes if buffered[i] for j in sorted(rtree.intersection(buffered[i])) if i < j)
+    
+    return populate_shared_segments(datasource, pairs, verbose, pool)
+
+pairings = {'combination': populate_shared_segments_by_combination,
+            'rtree': populate_shared_segments_by_rtree}
+
+def populate_shared_segments(datasource, pairs, verbose=False, pool=None):
+    """ Insert shared borders for an ordered sequence of candidate feature pairs.
+    
+        If a multiprocessing pool from start_pool() is given, intersections
+        are computed there. Results are inserted in the order of pairs either
+        way, so line_id and guid assignment matches a serial run.
+        
+        Return a list of shared border geometries for each feature.
+    """
+    shared = [[] for i in datasource._indexes()]
+    start, tested = time(), 0
+    
+    if pool is None:
+        shapes = datasource.shapes
+        borders = ((i, j, shared_border(shapes[i], shapes[j])) for (i, j) in pairs)
+    else:
+        borders = pool.imap(_pooled_shared_border, pairs, 64)
+    
+    for (i, j, border) in borders:
+        tested += 1
+        
+        if border is None:
+            continue
+        
+        if pool is not None:
+            border = loads(border)
+        
+        if border.area > 0:
+            raise Exception('Features %d and %d overlap - try the arcs builder' % (i, j))
+        
+        if verbose:
+            print >> stderr, 'Features %d and %d:' % (i, j), 'of', len(shared),
+        
+        geoms = hasattr(border, 'geoms') and border.geoms or [border]
+        
+        for geom in geoms:
+            coords = list(geom.coords)
+            insert_line(datasource, i, j, coords)
+            
+            if verbose:
+                print >> stderr, len(coords), '-',
+        
+        shared[i].append(border)
+        shared[j].append(border)
+        
+        if verbose:
+            print >> stderr, border.type
+    
+    found = len([border for borders in shared for border in borders]) / 2
+    tally(datasource.stats['load'], pairs_tested=tested, shared_borders=found, shared_seconds=time() - start)
+
+    return shared
+
+def populate_unshared_segments(datasource, shared, verbose=False, pool=None):
+    """ Insert the remaining boundary of each feature not covered by shared borders.
+    
+        If a multiprocessing pool from start_pool() is given, differences
+        are computed there and inserted in feature order.
+    """
+    start = time()
+    
+    if pool is None:
+        boundaries = (unshared_boundary(datasource.shapes[i], shared[i]) for i in datasource._indexes())
+    else:
+        tasks = ((i, [dumps(border) for border in shared[i]]) for i in datasource._indexes())
+        boundaries = (loads(wkb) for wkb in pool.imap(_pooled_unshared_boundary, tasks, 16))
+    
+    for (i, boundary) in enumerate(boundaries):
+        if verbose:
+            print >> stderr, 'Feature %d:' % i,
+    
+        geoms = hasattr(boundary, 'geoms') and boundary.geoms or [boundary]
+        geoms = [geom for geom in geoms if hasattr(geom, 'coords')]
+        
+        for geom in geoms:
+            coords = list(geom.coords)
+            insert_line(datasource, i, None, coords)
+    
+            if verbose:
+                print >> stderr, len(coords), '-',
+    
+        if verbose:
+            print >> stderr, boundary.type
+    
+    tally(datasource.stats['load'], unshared_boundaries=len(shared), unshared_seconds=time() - start)
+
+def populate_arcs(datasource, verbose=False):
+    """ Find and insert shared and unshared borders by cutting rings into arcs.
+    
+        Ring vertices are hashed, and any vertex with other than two distinct
+        neighbors is a junction where rings are cut. Each arc is inserted
+        once, shared by all the features whose rings include its edges. This
+        takes roughly linear time instead of an intersection and difference
+        for every touching pair, but only matches borders whose vertices are
+        exactly equal. Lines are cut at every junction, so some shared
+        borders that the overlay method merges arrive here as several lines.
+    """
+    start = time()
+    rings = [(i, ring) for i in datasource._indexes() for ring in shape_rings(datasource.shapes[i])]
+    neighbors, owners = {}, {}
+    
+    for (i, ring) in rings:
+        for (a, b) in zip(ring, ring[1:] + ring[:1]):
+            neighbors.setdefault(a, set()).add(b)
+            neighbors.setdefault(b, set()).add(a)
+            owners.setdefault(min(a, b) + max(a, b), set()).add(i)
+    
+    arcs = {}
+    
+    for (i, ring) in rings:
+        for arc in split_ring(ring, neighbors):
+            key = min(tuple(arc), tuple(arc[::-1]))
+            
+            if key not in arcs:
+                (a, b) = arc[:2]
+                arcs[key] = sorted(owners[min(a, b) + max(a, b)]), len(arcs), arc
+    
+    if verbose:
+        print >> stderr, len(rings), 'rings,', len(neighbors), 'vertices,', len(arcs), 'arcs.'
+    
+    # Insert shared arcs first by pair of features, then unshared arcs
+    # by feature, in the same order the overlay method would use. Arcs
+    # of overlapping layers can have more than two owners, and the rest
+    # are kept in datasource.owners by the line_id insert_line() will use.
+    
+    for (ids, k, arc) in sorted(arcs.values(), key=lambda value: (len(value[0]) == 1, value[0], value[1])):
+        if len(ids) > 2:
+            datasource.owners[datasource.next_guid - 1] = ids[2:]
+        
+        insert_line(datasource, ids[0], (len(ids) > 1) and ids[1] or None, arc)
+    
+    tally(datasource.stats['load'], rings=len(rings), vertices=len(neighbors), arcs=len(arcs), arc_seconds=time() - start)
+
+def shape_rings(shape):
+    """ Return a list of rings from a polygon or multipolygon.
+    
+        Rings are lists of points without repeated points or the closing point.
+    """
+    polygons = shape.geoms if hasattr(shape, 'geoms') else [shape]
+    rings = []
+    
+    for polygon in polygons:
+        if polygon.is_empty:
+            continue
+        
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            coords = list(ring.coords)
+            points = [point for (k, point) in enumerate(coords) if k == 0 or point != coords[k - 1]]
+            
+            if points[0] == points[-1]:
+                points.pop()
+            
+            if len(points) >= 3:
+                rings.append(points)
+    
+    return rings
+
+def split_ring(ring, neighbors):
+    """ Cut a ring into a list of arcs at junctions, vertices with other than two neighbors.
+    
+        A ring with no junctions is returned whole, starting at its lowest point
+        so that any other ring with the same points starts there as well.
+    """
+    cuts = [k for (k, point) in enumerate(ring) if len(neighbors[point]) != 2]
+    
+    if not cuts:
+        k = ring.index(min(ring))
+        return [ring[k:] + ring[:k+1]]
+    
+    start = cuts[0]
+    ring = ring[start:] + ring[:start + 1]
+    cuts = [k - start for k in cuts] + [len(ring) - 1]
+    
+    return [ring[a:b+1] for (a, b) in zip(cuts[:-1], cuts[1:])]
+
+def insert_line(datasource, src1_id, src2_id, coords):
+    """ Add a list of coordinates as one new line of segments.
+    
+        Segments are held in datasource.pending until flush_lines().
+        Guids are counted up from one, and each line_id is the number of
+        segments added before it. With a grid, coordinates are in cells
+        and rounded to whole numbers.
+    """
+    if datasource.grid is not None and len(coords):
+        # borders found by intersection can fall between cells.
+        coords = distinct_points(numpy.round(numpy.array(coords, numpy.float64)[:,:2]).astype(numpy.int64))
+    
+    if len(coords) < 2:
+        return
+    
+    guid = datasource.next_guid
+    line_id = guid - 1
+    
+    for (k, ((x1, y1), (x2, y2))) in enumerate(zip(coords[:-1], coords[1:])):
+        datasource.pending.append((guid + k, src1_id, src2_id, line_id, x1, y1, x2, y2))
+    
+    datasource.next_guid += len(coords) - 1
+
+def flush_lines(datasource):
+    """ Insert all pending segments into the segment store and spatial index at once.
+    
+        On the first flush the index is bulk-loaded from a stream, which is
+        much faster than adding entries one at a time.
+    """
+    start, rows, datasource.pending = time(), datasource.pending, []
+    datasource.segments.insert_many(rows)
+    
+    entries = [(guid, bbox(x1, y1, x2, y2), None) for (guid, src1_id, src2_id, line_id, x1, y1, x2, y2) in rows]
+    
+    if entries and entries[0][0] == 1:
+        # nothing has been indexed yet.
+        datasource.rtree = Rtree(entries)
+    
+    else:
+        for (guid, bounds, obj) in entries:
+            datasource.rtree.add(guid, bounds)
+    
+    lines = len([row for row in rows if row[0] - 1 == row[3]])
+    tally(datasource.stats['load'], lines=lines, segments=len(rows), flush_seconds=time() - start)
+
+def shared_border(shape1, shape2):
+    """ Return the merged border between two shapes, or None if they don't touch.
+    """
+    if not shape1.intersects(shape2):
+        return None
+    
+    return linemerge(shape1.intersection(shape2))
+
+def unshared_boundary(shape, borders):
+    """ Return the boundary of a shape minus a list of its shared borders.
+    """
+    if shape.is_empty:
+        return MultiLineString()
+    
+    boundary = shape.boundary
+    
+    for border in borders:
+        boundary = boundary.difference(border)
+    
+    return boundary
+
+def start_pool(datasource, workers):
+    """ Return a multiprocessing pool of workers primed with datasource shapes.
+    
+        Shapes are shipped once per worker as WKB.
+    """
+    return Pool(workers, _init_pool, (datasource.shapes.wkbs, datasource.shapes.shape.size))
+
+_pool_shapes = None
+
+def _init_pool(wkbs, cache_size):
+    global _pool_shapes
+    _pool_shapes = WKBShapes(wkbs, cache_size)
+
+def _pooled_shared_border(pair):
+    i, j = pair
+    border = shared_border(_pool_shapes[i], _pool_shapes[j])
+    return i, j, (border is not None) and dumps(border) or None
+
+def _pooled_unshared_boundary(task):
+    i, wkbs = task
+    return dumps(unshared_boundary(_pool_shapes[i], map(loads, wkbs)))
+
+def _pooled_collapse_line(task):
+    rows, neighbors, min_area, floor_area = task
+    segments, stats = LineSegments(rows, neighbors), {}
+    rtree = Rtree([(guid, bbox(*coords), None) for (guid, coords) in segments.coords.items()])
+    collapse_lines(segments, rtree, [None], min_area, floor_area, False, stats)
+    return rows, segments.log, stats
+
+def save(datasource, filename, tolerance=None, batch=1000, layer=0, precision=None):
+    """ Save one layer of a Datasource instance to a named OGR datasource.
+    
+        If a tolerance is given, linework is filtered from the areas recorded
+        by Datasource.rank() instead of using the current simplified state.
+        
+        Layer is the index or name of one of datasource.layers.
+        
+        Files ending in .geojson, .geojsonl or .ndjson are written directly
+        by GeoJSONWriter instead of OGR. Precision is a number of decimal
+        places to round coordinates to in GeoJSON output.
+        
+        Features are written in transactions of up to batch features.
+        
+        Returns a dictionary of counters and timings, also kept in stats.
+    """
+    start = time()
+    stats = datasource.stats['save'] = dict(filename=filename, tolerance=tolerance, layer=layer)
+    
+    names = [other.name for other in datasource.layers]
+    layer = datasource.layers[names.index(layer) if layer in names else layer]
+    
+    writer = create_writer(filename, layer.srs, layer.fields, precision, batch)
+    
+    polygons = feature_polygons(datasource, tolerance, layer.indexes(), stats)
+    features = ((datasource.values[i], polygons) for (i, polygons) in polygons)
+    
+    writer.write(features)
+    writer.close()
+    stats['seconds'] = time() - start
+    
+    return stats
+
+def create_writer(filename, srs, fields, precision=None, batch=1000):
+    """ Return a GeoJSONWriter or OGRWriter for a new file, chosen by its extension.
+    """
+    ext = splitext(filename)[1]
+    
+    if ext in geojson_formats:
+        return GeoJSONWriter(filename, srs, fields, precision, geojson_formats[ext])
+    
+    return OGRWriter(filename, srs, fields, precision, batch)
+
+class OGRWriter:
+    """ Write (values, polygons) features to a new OGR datasource.
+    """
+    def __init__(self, filename, srs, fields, precision=None, batch=1000):
+        """ Precision is passed on to the GeoJSON driver, and ignored by others.
+        """
+        self.fields, self.batch = fields, batch
+        self.source, self.layer = create_layer(filename, srs, fields, precision)
+    
+    def write(self, features):
+        write_features(self.layer, self.fields, features, self.batch)
+    
+    def close(self):
+        # OGR flushes a datasource to disk when it's dereferenced.
+        self.source, self.layer = None, None
+
+class GeoJSONWriter:
+    """ Write (values, polygons) features to a new GeoJSON file without OGR.
+    
+        Coordinates are formatted straight from the polygons, skipping
+        the WKB geometries and per-feature calls of the OGR path. Delimited
+        files have one feature per line and no surrounding FeatureCollection.
+    """
+    def __init__(self, filename, srs, fields, precision=None, delimited=False):
+        """ Precision is a number of decimal places to round coordinates to.
+        """
+        if exists(filename):
+            raise Exception('Failed creation of %s - is there one already?' % filename)
+        
+        self.file = open(filename, 'w')
+        self.names = [field.name for field in fields]
+        self.precision, self.delimited, self.count = precision, delimited, 0
+        
+        if not delimited:
+            self.file.write('{"type":"FeatureCollection",%s"features":[\n' % geojson_crs(srs))
+    
+    def write(self, features):
+        for (values, polygons) in features:
+            if self.delimited:
+                self.file.write(self.feature(values, polygons) + '\n')
+            else:
+                self.file.write((',\n' if self.count else '') + self.feature(values, polygons))
+            
+            self.count += 1
+    
+    def feature(self, values, polygons):
+        """ Return one feature as a string of GeoJSON.
+        """
+        properties = json_dumps(OrderedDict(zip(self.names, values)), separators=(',', ':'))
+        coordinates = ','.join(['[%s]' % ','.join([geojson_ring(ring, self.precision) for ring in [shell] + holes])
+                                for (shell, holes) in polygons])
+        
+        return '{"type":"Feature","properties":%s,"geometry":{"type":"MultiPolygon","coordinates":[%s]}}' % (properties, coordinates)
+    
+    def close(self):
+        if not self.delimited:
+            self.file.write('\n]}\n')
+        
+        self.file.close()
+
+def geojson_ring(ring, precision=None):
+    """ Return a list of (x, y) points as a string of GeoJSON coordinates.
+    """
+    if precision is None:
+        # repr() is the shortest string that reads back as the same float.
+        return '[%s]' % ','.join(['[%r,%r]' % (x, y) for (x, y) in ring])
+    
+    return '[%s]' % ','.join(['[%r,%r]' % (round(x, precision), round(y, precision)) for (x, y) in ring])
+
+def geojson_crs(srs):
+    """ Return a GeoJSON crs member and trailing comma for a spatial reference,
+        or an empty string for WGS84, which GeoJSON assumes, or an unknown one.
+    """
+    if srs is None:
+        return ''
+    
+    srs = srs.Clone()
+    srs.AutoIdentifyEPSG()
+    
+    if srs.GetAuthorityName(None) != 'EPSG' or srs.GetAuthorityCode(None) in (None, '4326'):
+        return ''
+    
+    return '"crs":{"type":"name","properties":{"name":"urn:ogc:def:crs:EPSG::%s"}},' % srs.GetAuthorityCode(None)
+
+def create_layer(filename, srs, fields, precision=None):
+    """ Create a named OGR datasource with one multipolygon layer, return both.
+    
+        Precision sets the number of decimal places for the GeoJSON driver.
+    """
+    ext = splitext(filename)[1]
     
     out_driver = ogr.GetDriverByName(drivers.get(ext))
     out_source = out_driver.CreateDataSource(filename)
@@ -444,62 +1768,803 @@ def save(datasource, filename):
     if out_source is None:
         raise Exception('Failed creation of %s - is there one already?' % filename)
     
-    out_layer = out_source.CreateLayer('default', datasource.srs, ogr.wkbMultiPolygon)
+    options = ['COORDINATE_PRECISION=%d' % precision] if (precision is not None and ext == '.json') else []
+    out_layer = out_source.CreateLayer('default', srs, ogr.wkbMultiPolygon, options)
     
-    for field in datasource.fields:
+    for field in fields:
         field_defn = ogr.FieldDefn(field.name, field.type)
         field_defn.SetWidth(field.width)
         out_layer.CreateField(field_defn)
     
-    for i in datasource._indexes():
+    return out_source, out_layer
+
+def write_features(out_layer, fields, features, batch=1000):
+    """ Write (values, polygons) features to an OGR layer.
     
-        segments = datasource.db.execute("""SELECT x1, y1, x2, y2
-                                            FROM segments
-                                            WHERE (src1_id = ? OR src2_id = ?)
-                                              AND removed = 0""", (i, i))
+        Features are written in transactions of up to batch features.
+    """
+    out_layer.StartTransaction()
     
-        lines = [datasource.memo_line(x1, y1, x2, y2) for (x1, y1, x2, y2) in segments]
+    for (count, (values, polygons)) in enumerate(features):
+        feat = ogr.Feature(out_layer.GetLayerDefn())
         
-        try:
-            poly = polygonize(lines).next()
+        for (j, field) in enumerate(fields):
+            feat.SetField(field.name, values[j])
+        
+        geom = ogr.CreateGeometryFromWkb(multipolygon_wkb(polygons))
+        
+        feat.SetGeometry(geom)
+    
+        out_layer.CreateFeature(feat)
+        
+        if count % batch == batch - 1:
+            out_layer.CommitTransaction()
+            out_layer.StartTransaction()
+    
+    out_layer.CommitTransaction()
+
+def feature_polygons(datasource, tolerance=None, indexes=None, stats=None):
+    """ Generate (index, polygons) for each feature in a Datasource instance,
+        or for just the features in a list of indexes.
+    
+        Polygons are lists of (shell, holes) built by stitching together the
+        lines around each feature, with polygonize() as a fallback for any
+        feature whose lines don't close into rings. Small features that
+        disappear are skipped with a message.
+        
+        If a stats dictionary is given, features that were stitched,
+        polygonized or skipped are counted in it with tally().
+    """
+    stats = {} if stats is None else stats
+    borders = [[] for i in datasource._indexes()]
+    
+    for (line_id, src1_id, src2_id, points) in datasource.lines(tolerance):
+        borders[src1_id].append(points)
+        
+        if src2_id is not None:
+            borders[src2_id].append(points)
+        
+        for src_id in datasource.owners.get(line_id, []):
+            borders[src_id].append(points)
     
-        except StopIteration:
-            lost_area = datasource.shapes[i].area
-            lost_portion = lost_area / (datasource.tolerance ** 2)
+    for i in datasource._indexes() if indexes is None else indexes:
+        if i in datasource.collapsed:
+            # snapped to nothing when it was loaded.
+            print >> stderr, 'Skipped small feature #%(i)d' % locals()
+            tally(stats, skipped=1)
+            continue
+        
+        rings, leftovers = stitch_rings(borders[i])
+        
+        if rings and not leftovers:
+            polygons = nest_rings(rings)
+            tally(stats, stitched=1)
+        
+        else:
+            segments = [line[k:k+2] for line in borders[i] for k in range(len(line) - 1)]
+            lines = [datasource.memo_line(x1, y1, x2, y2) for ((x1, y1), (x2, y2)) in segments]
             
-            if lost_portion < 4:
-                # It's just small.
-                print >> stderr, 'Skipped small feature #%(i)d' % locals()
+            try:
+                poly = polygonize(lines).next()
+                polygons = [(list(poly.exterior.coords), [list(ring.coords) for ring in poly.interiors])]
+                tally(stats, polygonized=1)
+        
+            except StopIteration:
+                tally(stats, polygonize_failures=1)
+
+                # features can shrink away below the tolerance or the grid size.
+                lost_area = datasource.areas[i]
+                scale = max(tolerance or datasource.tolerance, datasource.grid.size if datasource.grid else 0)
+                
+                if scale and lost_area / scale ** 2 < 4:
+                    # It's just small.
+                    print >> stderr, 'Skipped small feature #%(i)d' % locals()
+                    tally(stats, skipped=1)
+                    continue
+        
+                # This is a bug we don't understand yet.
+                raise Exception('Failed to get a meaningful polygon out of large feature #%(i)d' % locals())
+        
+        borders[i] = None
+        
+        yield i, polygons
+
+def stitch_rings(lines):
+    """ Join lists of points end to end into closed rings.
+    
+        Where more than two lines meet, a chain that comes back to a point
+        it already passed closes off the loop since then as a ring of its
+        own. Loops are split again by split_loops() where a single line
+        passes through a point twice, so rings never touch themselves.
+        
+        Returns a list of rings with at least three distinct points and
+        non-zero area, and a count of chains that could not be closed.
+    """
+    ends, used = {}, [False] * len(lines)
+    
+    for (k, line) in enumerate(lines):
+        ends.setdefault(line[0], []).append(k)
+        ends.setdefault(line[-1], []).append(k)
+    
+    loops, leftovers = [], 0
+    
+    for (k, line) in enumerate(lines):
+        if used[k]:
+            continue
+        
+        # joins are the positions of line ends in the chain so far.
+        used[k], ring = True, list(line)
+        joins = {ring[0]: 0}
+        
+        while ring[-1] != ring[0] or len(ring) > 1:
+            if ring[-1] in joins and joins[ring[-1]] < len(ring) - 1:
+                start = joins[ring[-1]]
+                loops.append(ring[start:])
+                ring = ring[:start + 1]
+                joins = dict([(point, i) for (point, i) in joins.items() if i <= start])
                 continue
+            
+            joins[ring[-1]] = len(ring) - 1
+            
+            for other in ends[ring[-1]]:
+                if not used[other]:
+                    break
+            else:
+                # nothing left to continue this chain.
+                break
+            
+            used[other], points = True, lines[other]
+            ring.extend((points[0] == ring[-1]) and points[1:] or points[-2::-1])
+        
+        if ring[-1] != ring[0]:
+            leftovers += 1
+    
+    rings = [ring for loop in loops for ring in split_loops(loop)
+             if len(ring) >= 4 and signed_area(ring) != 0]
+    
+    return rings, leftovers
+
+def split_loops(ring):
+    """ Split a closed ring into rings at each point it passes more than once.
+    """
+    loops, path, seen = [], [], {}
     
-            # This is a bug we don't understand yet.
-            raise Exception('Failed to get a meaningful polygon out of large feature #%(i)d' % locals())
+    for point in ring:
+        if point in seen:
+            start = seen[point]
+            loops.append(path[start:] + [point])
+            path = path[:start + 1]
+            seen = dict([(other, i) for (other, i) in seen.items() if i <= start])
         
-        feat = ogr.Feature(out_layer.GetLayerDefn())
+        else:
+            seen[point] = len(path)
+            path.append(point)
+    
+    return loops
+
+def nest_rings(rings):
+    """ Sort closed rings into a list of (shell, holes) polygons.
+    
+        Rings are placed from largest to smallest inside the smallest ring
+        already placed that contains them. Rings inside a shell become its
+        holes, and rings inside a hole become new shells. Shells are
+        returned counterclockwise and holes clockwise.
+    """
+    rings = sorted(rings, key=lambda ring: -abs(signed_area(ring)))
+    placed, polygons = [], []
+    
+    for ring in rings:
+        x, y = ring_point(ring)
         
-        for (j, field) in enumerate(datasource.fields):
-            feat.SetField(field.name, datasource.values[i][j])
+        # placed rings are in decreasing size, so the last container is smallest.
+        containers = [(ring2, is_hole, shell) for (ring2, is_hole, shell) in placed if point_in_ring(x, y, ring2)]
         
-        geom = ogr.CreateGeometryFromWkb(dumps(poly))
+        if containers and not containers[-1][1]:
+            shell = containers[-1][2]
+            shell[1].append((signed_area(ring) > 0) and ring[::-1] or ring)
+            placed.append((ring, True, shell))
         
-        feat.SetGeometry(geom)
+        else:
+            shell = ((signed_area(ring) < 0) and ring[::-1] or ring, [])
+            polygons.append(shell)
+            placed.append((ring, False, shell))
     
-        out_layer.CreateFeature(feat)
+    return polygons
+
+def signed_area(ring):
+    """ Return the area of a closed ring, positive if counterclockwise.
+    """
+    return sum([x1 * y2 - x2 * y1 for ((x1, y1), (x2, y2)) in zip(ring[:-1], ring[1:])]) / 2.
+
+def ring_point(ring):
+    """ Return the midpoint of a ring's first segment, a point on its boundary.
+    """
+    (x1, y1), (x2, y2) = ring[:2]
+    return (x1 + x2) / 2., (y1 + y2) / 2.
+
+def point_in_ring(x, y, ring):
+    """ Return true if a point falls inside a closed ring, by ray casting.
+    """
+    inside = False
+    
+    for ((x1, y1), (x2, y2)) in zip(ring[:-1], ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    
+    return inside
+
+def multipolygon_wkb(polygons):
+    """ Return well-known binary for a list of (shell, holes) polygons.
+    """
+    parts = [pack('<BII', 1, 6, len(polygons))]
+    
+    for (shell, holes) in polygons:
+        parts.append(pack('<BII', 1, 3, 1 + len(holes)))
+        
+        for ring in [shell] + holes:
+            parts.append(pack('<I', len(ring)))
+            parts.append(pack('<%dd' % (len(ring) * 2), *[n for point in ring for n in point]))
+    
+    return ''.join(parts)
+
+def simplify_partitioned(filename, outputs, tiles=(4, 4), workers=None, verbose=False, precision=None, **kwargs):
+    """ Simplify an OGR data source too large for memory one partition at a time.
+    
+        Features are split into a grid of columns and rows by the centers
+        of their bounding boxes, and only envelopes are read for the whole
+        source. Each partition loads its own features plus a halo of other
+        features whose bounding boxes touch them. Lines bordering the halo
+        are pinned so they are never collapsed, which keeps borders between
+        partitions identical on both sides. Outputs is a list of (tolerance,
+        filename) pairs, and each file gets features from every partition,
+        in partition order. If workers is given, partitions are simplified
+        in a process pool of that size. Precision is passed to save()'s
+        writers, and other keyword arguments go to load().
+        
+        Returns a list with a dictionary of load and simplify stats for each
+        partition.
+    """
+    source = ogr.Open(filename)
+    layer = source.GetLayer(0)
+    srs, geom_type, fields = layer_schema(layer)
+    
+    partitions = partition_features(layer, tiles)
+    
+    if verbose:
+        print >> stderr, 'Split', layer.GetFeatureCount(), 'features into', len(partitions), 'partitions.'
+    
+    outputs = sorted(outputs)
+    tolerances = [tolerance for (tolerance, outfile) in outputs]
+    writers = [create_writer(outfile, srs, fields, precision) for (tolerance, outfile) in outputs]
+    
+    tasks = [(filename, own, halo, tolerances, kwargs) for (own, halo) in partitions]
+    pool = workers and Pool(workers) or None
+    stats = []
+    
+    try:
+        results = (_simplify_partition(task) for task in tasks) if pool is None else pool.imap(_simplify_partition, tasks)
+        
+        for (k, (features, partition_stats)) in enumerate(results):
+            stats.append(partition_stats)
+            
+            for (writer, tolerance_features) in zip(writers, features):
+                writer.write(tolerance_features)
+            
+            if verbose:
+                print >> stderr, 'Partition %d of %d:' % (k + 1, len(tasks)), len(partitions[k][0]), 'features,',
+                print >> stderr, len(partitions[k][1]), 'in halo.'
+    
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    for writer in writers:
+        writer.close()
+    
+    return stats
+
+def partition_features(layer, tiles):
+    """ Return a list of (own, halo) lists of feature ids for each non-empty grid cell.
+    
+        Only feature envelopes are read. Halo features are those in other
+        cells whose envelopes intersect the envelope of an own feature.
+    """
+    columns, rows = tiles
+    envelopes, rtree = {}, Rtree()
+    
+    for feature in layer:
+        xmin, xmax, ymin, ymax = feature.geometry().GetEnvelope()
+        envelopes[feature.GetFID()] = (xmin, ymin, xmax, ymax)
+        rtree.add(feature.GetFID(), (xmin, ymin, xmax, ymax))
+    
+    if not envelopes:
+        return []
+    
+    xmin, ymin = min([e[0] for e in envelopes.values()]), min([e[1] for e in envelopes.values()])
+    xmax, ymax = max([e[2] for e in envelopes.values()]), max([e[3] for e in envelopes.values()])
+    width, height = (xmax - xmin) / columns or 1, (ymax - ymin) / rows or 1
+    
+    cells = {}
+    
+    for fid in sorted(envelopes):
+        x1, y1, x2, y2 = envelopes[fid]
+        column = min(int(((x1 + x2) / 2 - xmin) / width), columns - 1)
+        row = min(int(((y1 + y2) / 2 - ymin) / height), rows - 1)
+        cells.setdefault((column, row), []).append(fid)
+    
+    partitions = []
+    
+    for cell in sorted(cells):
+        own = cells[cell]
+        owned = set(own)
+        halo = set([fid for own_fid in own for fid in rtree.intersection(envelopes[own_fid])])
+        partitions.append((own, sorted(halo - owned)))
+    
+    return partitions
+
+def _simplify_partition(task):
+    """ Load and simplify one partition, return a list of its own (values, polygons)
+        features for each tolerance, and a dictionary of stats.
+    """
+    filename, own, halo, tolerances, kwargs = task
+    
+    datasource = load(filename, fids=own + halo, **kwargs)
+    
+    # features past the own ones are in the halo, and any line they touch is pinned.
+    
+    for (line_id, src1_id, src2_id, points) in datasource.lines():
+        src_ids = [src1_id, src2_id] + datasource.owners.get(line_id, [])
+        
+        if [src_id for src_id in src_ids if src_id is not None and src_id >= len(own)]:
+            datasource.pinned.add(line_id)
+    
+    features, stats = [], dict(load=datasource.stats['load'], simplify=[], save=[])
+    
+    for tolerance in tolerances:
+        stats['simplify'].append(datasource.simplify(tolerance))
+        stats['save'].append(dict(tolerance=tolerance))
+        
+        polygons = feature_polygons(datasource, indexes=range(len(own)), stats=stats['save'][-1])
+        features.append([(datasource.values[i], polygon) for (i, polygon) in polygons])
+    
+    return features, stats
+
+def dump_topology(datasource, filename, source=None):
+    """ Write a Datasource instance to a topology file for load_topology().
+    
+        The file starts with a JSON header holding fields, values, areas, srs,
+        layers, grid and simplification state, followed by raw arrays of segment
+        columns. If source names the data files the datasource was loaded
+        from, in any form load() accepts, their sizes and modification times
+        are recorded for topology_matches(), along with the builder and
+        quantize options they were loaded with.
+    """
+    load_stats = datasource.stats.get('load', {})
+    
+    header = dict(srs=datasource.srs and datasource.srs.ExportToWkt(),
+                  geom_type=datasource.geom_type,
+                  fields=[(field.name, field.type, field.width) for field in datasource.fields],
+                  values=[list(values) for values in datasource.values],
+                  areas=datasource.areas,
+                  tolerance=datasource.tolerance,
+                  rank_floor=datasource.rank_floor,
+                  pinned=sorted(datasource.pinned),
+                  owners=sorted(datasource.owners.items()),
+                  layers=[(layer.name, layer.srs and layer.srs.ExportToWkt(), layer.geom_type,
+                           [(field.name, field.type, field.width) for field in layer.fields],
+                           layer.start, layer.count) for layer in datasource.layers],
+                  source=source and source_signature(source),
+                  builder=load_stats.get('builder'),
+                  quantize=load_stats.get('quantize'),
+                  collapsed=sorted(datasource.collapsed),
+                  grid=datasource.grid and (datasource.grid.size, datasource.grid.column,
+                                            datasource.grid.row, datasource.grid.coord_type.name),
+                  arrays=[])
+    
+    arrays, offset = datasource.segments.columns(), 0
+    
+    for (name, array) in zip(topology_arrays, arrays):
+        header['arrays'].append((name, array.dtype.str, array.shape, offset))
+        offset += aligned(array.nbytes)
+    
+    text = json_dumps(header)
+    file = open(filename, 'wb')
+    
+    file.write(topology_magic + pack('<Q', len(text)) + text)
+    file.write('\0' * (aligned(file.tell()) - file.tell()))
+    
+    for array in arrays:
+        file.write(numpy.ascontiguousarray(array).tostring())
+        file.write('\0' * (aligned(array.nbytes) - array.nbytes))
+    
+    file.close()
+
+def load_topology(filename, store='array', memo_size=65536):
+    """ Load a topology file from dump_topology(), return a new Datasource instance.
+    
+        Segment arrays are memory-mapped copy-on-write, so with the array
+        store nothing is read until it's needed and the file is never changed.
+        Source shapes are not kept, so the result can be simplified and saved
+        but not loaded into further.
+    """
+    started = time()
+    header, start = read_topology_header(filename)
+    
+    srs = header['srs'] and osr.SpatialReference(header['srs']) or None
+    fields = [Field(*field) for field in header['fields']]
+    
+    grid = header.get('grid') and Grid(*header['grid'])
+    
+    datasource = Datasource(srs, header['geom_type'], fields, header['values'], None, store, memo_size, header['areas'], grid)
+    datasource.tolerance = header['tolerance']
+    datasource.rank_floor = header['rank_floor']
+    datasource.pinned = set(header['pinned'])
+    datasource.collapsed = set(header.get('collapsed', []))
+    datasource.owners = dict([(line_id, owners) for (line_id, owners) in header['owners']])
+    
+    datasource.layers = [Layer(name, wkt and osr.SpatialReference(wkt), geom_type, [Field(*field) for field in layer_fields], first, count)
+                         for (name, wkt, geom_type, layer_fields, first, count) in header['layers']]
+    
+    columns = []
+    
+    for (name, dtype, shape, offset) in header['arrays']:
+        if numpy.prod(shape):
+            columns.append(numpy.memmap(filename, dtype, 'c', start + offset, tuple(shape)))
+        else:
+            columns.append(numpy.empty(shape, dtype))
+    
+    datasource.segments.load_columns(*columns)
+    datasource.next_guid += len(columns[2])
+    
+    # the index is rebuilt rather than stored, because simplify() changes it in place.
+    stream = [(guid, bbox(x1, y1, x2, y2), None) for (guid, x1, y1, x2, y2) in datasource.segments.live_segments()]
+    datasource.rtree = stream and Rtree(stream) or Rtree()
+    
+    datasource.stats['load'] = dict(topology=filename, features=len(datasource.values),
+                                    segments=len(columns[2]), seconds=time() - started,
+                                    builder=header.get('builder'), quantize=header.get('quantize'))
+    
+    return datasource
+
+def topology_matches(filename, source, builder='overlay', quantize=None):
+    """ Return true if a topology file exists and was dumped from unchanged source files.
+    
+        Builder and quantize are the options load() would be given, and
+        must match the ones the topology was loaded with.
+    """
+    if not exists(filename):
+        return False
+    
+    try:
+        header, start = read_topology_header(filename)
+    except Exception:
+        return False
+    
+    if header.get('builder') != builder or header.get('quantize') != quantize:
+        return False
+    
+    return header['source'] == source_signature(source)
+
+def read_topology_header(filename):
+    """ Return the JSON header of a topology file and the offset of its arrays.
+    """
+    file = open(filename, 'rb')
+    
+    if file.read(len(topology_magic)) != topology_magic:
+        raise Exception('%s is not a Bloch topology file' % filename)
+    
+    length = unpack('<Q', file.read(8))[0]
+    header = json_loads(file.read(length))
+    
+    return header, aligned(file.tell())
+
+def source_signature(filename):
+    """ Return a list of path, size and modification time for each data file
+        of anything accepted by layer_sources(), with the attribute files of
+        shapefiles included.
+    """
+    filenames = []
+    
+    for (name, layer) in layer_sources(filename):
+        filenames.append(name)
+        
+        if splitext(name)[1] == '.shp':
+            filenames.append(splitext(name)[0] + '.dbf')
+    
+    return [[abspath(name), stat(name).st_size, stat(name).st_mtime]
+            for name in filenames if exists(name)]
+
+def aligned(offset):
+    return (offset + 15) // 16 * 16
+
+topology_magic = 'Bloch topology\n'
+topology_arrays = ('src1', 'src2', 'line', 'coords', 'removed', 'area')
+
+def columns_from_rows(rows, coord_type=numpy.float64):
+    """ Return ArraySegments.columns() for a list of complete segment rows.
+    """
+    n = len(rows)
+    
+    src1, src2 = numpy.empty(n, numpy.int64), numpy.empty(n, numpy.int64)
+    line, coords = numpy.empty(n, numpy.int64), numpy.empty((n, 4), coord_type)
+    removed, area = numpy.empty(n, numpy.bool_), numpy.empty(n, numpy.float64)
+    
+    for (i, (guid, src1_id, src2_id, line_id, x1, y1, x2, y2, flag, value)) in enumerate(rows):
+        src1[i], src2[i], line[i] = src1_id, -1 if src2_id is None else src2_id, line_id
+        coords[i], removed[i], area[i] = (x1, y1, x2, y2), flag, numpy.nan if value is None else value
+    
+    return src1, src2, line, coords, removed, area
+
+def group_positions(keys, positions):
+    """ Split positions into a dictionary of arrays by runs of sorted keys.
+    """
+    if not len(keys):
+        return {}
+    
+    breaks = numpy.nonzero(numpy.diff(keys))[0] + 1
+    starts = numpy.concatenate(([0], breaks))
+    
+    return dict([(int(keys[start]), chunk) for (start, chunk) in zip(starts, numpy.split(positions, breaks))])
+
+def collapse_lines(segments, rtree, line_ids, min_area, floor_area=0, verbose=False, stats=None):
+    """ Remove every vertex on the given lines whose effective area is below min_area.
+    
+        Each vertex is the apex of a triangle with its two neighbors.
+        Triangle areas go into a single min-heap, and when a vertex is
+        collapsed only its two neighbors are re-evaluated, so one call
+        removes everything below min_area in a single pass. Areas never
+        drop below that of a previously-collapsed neighbor or floor_area,
+        which keeps the order of removal stable as the line changes under it.
+        Vertices rejected for crossing another segment are tried again
+        after any pass that collapsed something, until a pass removes nothing,
+        and recorded at no less than the largest area collapsed before them.
+        
+        Segments is a segment store and rtree its spatial index, both kept
+        up to date with each collapse.
+        
+        Returns the number of collapsed vertices. If a stats dictionary
+        is given, counters for this pass are added to it with tally().
+    """
+    # Segments are keyed by guid, and each vertex is identified by the
+    # guid of the segment that starts there. A vertex can be collapsed
+    # if there's a previous segment on the same line to extend over it.
+    segs, before, after, heap = {}, {}, {}, []
+    
+    for line_id in line_ids:
+        rows = segments.line_segments(line_id)
+        guids = [guid for (guid, x1, y1, x2, y2) in rows]
+        
+        for (guid, x1, y1, x2, y2) in rows:
+            segs[guid] = (x1, y1, x2, y2)
+        
+        for (guid1, guid2) in zip(guids[:-1], guids[1:]):
+            after[guid1], before[guid2] = guid2, guid1
+        
+        if len(rows) > 1:
+            areas = triangle_areas(numpy.array(rows, numpy.float64)[:,1:])
+            areas = numpy.maximum(areas, floor_area).tolist()
+            heap.extend(zip(areas, guids[1:], [0] * len(areas)))
+    
+    # Each heap entry carries a stamp that must match the latest stamp
+    # for its vertex, so entries made obsolete by a collapse are skipped.
+    stamps = dict([(guid, 0) for guid in before])
+    heapify(heap)
+    
+    collapsed, stale, queries, checks, rejected = 0, 0, 0, 0, 0
+    retries, progress, highest = [], 0, floor_area
+    
+    while heap or retries:
+        if not heap or heap[0][0] > min_area:
+            # there won't be any more points to remove, unless collapses
+            # since the last pass have cleared the way for rejected ones.
+            if collapsed == progress:
+                break
+            
+            heap, retries, progress = retries, [], collapsed
+            heapify(heap)
+            continue
+        
+        area, guid2, stamp = heappop(heap)
+        
+        if stamps.get(guid2) != stamp:
+            # this vertex has been collapsed or re-evaluated since.
+            stale += 1
+            continue
+        
+        guid1 = before[guid2]
+        (x1, y1, xa, ya), (xb, yb, x2, y2) = segs[guid1], segs[guid2]
+        
+        # Check the resulting flattened line against the rest
+        # any of the original shapefile, to determine if it would
+        # cross any existing line segment.
+        
+        old_guids = rtree.intersection(bbox(x1, y1, x2, y2))
+        old_coords = numpy.array(segments.coordinates(old_guids), numpy.float64).reshape(-1, 4)
+        queries, checks = queries + 1, checks + len(old_coords)
+        
+        if crossings(x1, y1, x2, y2, old_coords).any():
+            # leave this vertex in place until a neighbor or another line moves.
+            retries.append((area, guid2, stamp))
+            rejected += 1
+            
+            if verbose:
+                stderr.write('x%d' % guid2)
+            continue
+        
+        # A retried vertex comes back with the area it was rejected at, so
+        # it's recorded no lower than anything collapsed before it. Areas
+        # then stay in the order of removal, and every tolerance rank()
+        # can produce is a state that was checked for crossings.
+        area = highest = max(area, highest)
+        
+        segments.remove(guid2, area)
+        segments.update(guid1, x1, y1, x2, y2)
+        
+        # Keep the spatial index in step with the segments, deleting
+        # entries by the exact bounds they were inserted with.
+        
+        rtree.delete(guid2, bbox(xb, yb, x2, y2))
+        rtree.delete(guid1, bbox(x1, y1, xa, ya))
+        rtree.add(guid1, bbox(x1, y1, x2, y2))
+        
+        collapsed += 1
+        
+        # Splice the collapsed segment out of the line.
+        
+        segs[guid1] = (x1, y1, x2, y2)
+        guid3 = after.pop(guid2, None)
+        del segs[guid2], before[guid2], stamps[guid2]
+        
+        if guid3 is None:
+            del after[guid1]
+        else:
+            after[guid1], before[guid3] = guid3, guid1
+        
+        # Re-evaluate the two neighbors of the collapsed vertex.
+        
+        for guid in (guid1, guid3):
+            if guid in before:
+                stamps[guid] += 1
+                new_area = max(area, vertex_area(segs[before[guid]], segs[guid]))
+                heappush(heap, (new_area, guid, stamps[guid]))
+    
+    if stats is not None:
+        tally(stats, removed=collapsed, stale_entries=stale,
+              rtree_queries=queries, crossing_checks=checks, rejected=rejected)
+    
+    return collapsed
+
+def independent_batches(boxes):
+    """ Group indexes of bounding boxes into batches of boxes that don't intersect.
+    
+        Each box goes into the batch after the latest one holding a box it
+        intersects, so processing batches in turn keeps every intersecting
+        pair in its original order.
+    """
+    index, levels, batches = Rtree(), [], []
+    
+    for (i, box) in enumerate(boxes):
+        level = max([levels[j] + 1 for j in index.intersection(box)] or [0])
+        index.add(i, box)
+        levels.append(level)
+        
+        if level == len(batches):
+            batches.append([])
+        
+        batches[level].append(i)
+    
+    return batches
+
+def line_bbox(rows):
+    """ Return the bounding box of (guid, x1, y1, x2, y2) rows.
+    """
+    coords = numpy.array(rows, numpy.float64)[:,1:].reshape(-1, 2)
+    return tuple(coords.min(axis=0)) + tuple(coords.max(axis=0))
+
+def crossings(x1, y1, x2, y2, coords):
+    """ Return a boolean array of which segments in coords cross one segment.
+    
+        Coords is an (n, 4) array of x1, y1, x2, y2. Segments cross when they
+        meet at a single point inside both, the same as shapely's crosses()
+        for two-point lines: touching at an endpoint or overlapping along
+        a common direction is not crossing.
+    """
+    x3, y3, x4, y4 = coords[:,0], coords[:,1], coords[:,2], coords[:,3]
+    
+    # Orientation of each end of one segment relative to the other;
+    # a crossing puts the ends strictly on opposite sides both ways.
+    d1 = (x2 - x1) * (y3 - y1) - (y2 - y1) * (x3 - x1)
+    d2 = (x2 - x1) * (y4 - y1) - (y2 - y1) * (x4 - x1)
+    d3 = (x4 - x3) * (y1 - y3) - (y4 - y3) * (x1 - x3)
+    d4 = (x4 - x3) * (y2 - y3) - (y4 - y3) * (x2 - x3)
+    
+    return (numpy.sign(d1) * numpy.sign(d2) < 0) & (numpy.sign(d3) * numpy.sign(d4) < 0)
+
+def tally(stats, **counts):
+    """ Add counts to a dictionary of counters, starting any missing ones at zero.
+    """
+    for (key, count) in counts.items():
+        stats[key] = stats.get(key, 0) + count
+
+def distinct_points(points):
+    """ Return an (n, 2) array of points as a list, without repeated consecutive points.
+    """
+    points = numpy.asarray(points)
+    
+    if len(points) == 0:
+        return []
+    
+    keep = numpy.ones(len(points), numpy.bool_)
+    keep[1:] = (points[1:] != points[:-1]).any(axis=1)
+    
+    return map(tuple, points[keep].tolist())
 
 def bbox(x1, y1, x2, y2):
     return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
 
-def make_memo_line():
-    """ Return a function that memorizes line strings to save on construction costs.
+def vertex_area(seg1, seg2):
+    """ Return the area of the triangle at the shared vertex of two segments.
+    """
+    (x1, y1, x2, y2), (x3, y3) = seg1, seg2[2:]
+    return abs((x2 - x1) * (y3 - y1) - (x3 - x1) * (y2 - y1)) / 2.
+
+def triangle_areas(coords):
+    """ Return an array of vertex_area() for each consecutive pair of segments.
+    
+        Coords is an (n, 4) array of x1, y1, x2, y2 for segments along a line,
+        and the result has one area for each of the n - 1 interior vertices.
     """
-    line_memory = {}
+    x1, y1, x2, y2 = coords[:-1,0], coords[:-1,1], coords[:-1,2], coords[:-1,3]
+    x3, y3 = coords[1:,2], coords[1:,3]
     
-    def memo_line(x1, y1, x2, y2):
-        key = (x1, y1, x2, y2)
+    return numpy.abs((x2 - x1) * (y3 - y1) - (x3 - x1) * (y2 - y1)) / 2.
 
-        if key not in line_memory:
-            line_memory[key] = LineString([(x1, y1), (x2, y2)])
+class BoundedCache:
+    """ Callable that memorizes results of a function for its most recent arguments.
+    
+        Up to size results are kept, and the least recently used one is
+        evicted to make room for a new one. Size of None means no limit.
+        Hits, misses and evictions are counted so the cache can be judged.
+    """
+    def __init__(self, function, size=None):
+        self.function = function
+        self.size = size
+        self.memory = OrderedDict()
+        
+        self.hits, self.misses, self.evictions = 0, 0, 0
+    
+    def __call__(self, *args):
+        try:
+            # popped and put back below to mark it most recently used.
+            value = self.memory.pop(args)
+            self.hits += 1
+        
+        except KeyError:
+            value = self.function(*args)
+            self.misses += 1
+            
+            if self.size is not None and self.memory and len(self.memory) >= self.size:
+                self.memory.popitem(False)
+                self.evictions += 1
+        
+        if self.size != 0:
+            self.memory[args] = value
+        
+        return value
+    
+    def stats(self):
+        """ Return a dictionary of usage counters.
+        """
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=len(self.memory), limit=self.size)
 
-        return line_memory[key]
+def make_memo_line(size=None):
+    """ Return a function that memorizes line strings to save on construction costs.
+    
+        The function is a BoundedCache holding up to size line strings.
+    """
+    def line(x1, y1, x2, y2):
+        return LineString([(x1, y1), (x2, y2)])
 
-    return memo_line
+    return BoundedCache(line, size)
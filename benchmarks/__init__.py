@@ -0,0 +1,9 @@
+""" Benchmarks for Bloch, run as modules from the top of the repository.
+
+Example usage:
+
+  python -m benchmarks.pairing 100 400 1600
+  python -m benchmarks.suite --json baseline.json 100 1000 10000
+  python -m benchmarks.output -p 2 counties.shp
+
+"""
@@ -0,0 +1,76 @@
+""" Compare one-at-a-time and bulk insertion of segments.
+
+Loads a data file, or a synthetic grid coverage if none is given, then times
+inserting all of its segments into fresh segment stores and spatial indexes:
+one insert() and Rtree.add() per segment, and one insert_many() with a
+bulk-loaded Rtree stream.
+"""
+
+from os import close, unlink
+from time import time
+from tempfile import mkstemp
+from optparse import OptionParser
+
+from rtree import Rtree
+
+from Bloch import load, stores, bbox
+from benchmarks.synthetic import grid_coverage, write_geojson
+
+parser = OptionParser(usage="""%prog [options] [<input file>]
+
+Example:
+
+  python -m benchmarks.insertion counties.shp""")
+
+parser.set_defaults(features=2500, vertices=10)
+
+parser.add_option('-f', '--features', dest='features',
+                  help='Number of features in the coverage when no input file is given, default %default',
+                  type='int')
+
+parser.add_option('-n', '--vertices', dest='vertices',
+                  help='Intermediate vertices per grid edge when no input file is given, default %default',
+                  type='int')
+
+def insert_each(store, rows):
+    rtree = Rtree()
+    
+    for (guid, src1_id, src2_id, line_id, x1, y1, x2, y2) in rows:
+        guid = store.insert(src1_id, src2_id, line_id, x1, y1, x2, y2)
+        rtree.add(guid, bbox(x1, y1, x2, y2))
+
+def insert_bulk(store, rows):
+    store.insert_many(rows)
+    Rtree([(guid, bbox(x1, y1, x2, y2), None) for (guid, src1_id, src2_id, line_id, x1, y1, x2, y2) in rows])
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+    
+    if args:
+        filename, temporary = args[0], False
+    
+    else:
+        side = max(1, int(round(opts.features ** .5)))
+        handle, filename = mkstemp(suffix='.json')
+        close(handle)
+        temporary = True
+        
+        write_geojson([[ring] for ring in grid_coverage(side, side, opts.vertices)], filename)
+    
+    start = time()
+    datasource = load(filename, builder='arcs')
+    print 'Loaded %s in %.3fs' % (filename, time() - start)
+    
+    if temporary:
+        unlink(filename)
+    
+    rows = [row[:8] for row in datasource.segments.rows()]
+    print '%d segments' % len(rows)
+    
+    for name in sorted(stores):
+        for (label, insert) in (('each', insert_each), ('bulk', insert_bulk)):
+            start = time()
+            insert(stores[name](), rows)
+            elapsed = time() - start
+            
+            print '%6s %4s: %.3fs, %.0f segments/sec' % (name, label, elapsed, len(rows) / elapsed)
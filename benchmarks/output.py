@@ -0,0 +1,74 @@
+""" Compare saving through OGR with the GeoJSON writer.
+
+Loads a data file, or a synthetic Voronoi coverage if none is given, and
+simplifies it once. Then times save() to GeoJSON through OGR, and to .geojson
+and .ndjson files from GeoJSONWriter, at full and rounded coordinate precision.
+"""
+
+from os.path import join, getsize
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from optparse import OptionParser
+
+from Bloch import load, save, geojson_formats
+from benchmarks.synthetic import voronoi_coverage, write_geojson
+
+parser = OptionParser(usage="""%prog [options] [<input file>]
+
+Example:
+
+  python -m benchmarks.output -p 2 -t 500 counties.shp""")
+
+parser.set_defaults(features=2500, vertices=4, tolerance=.05, precision=6)
+
+parser.add_option('-f', '--features', dest='features',
+                  help='Number of features in the coverage when no input file is given, default %default',
+                  type='int')
+
+parser.add_option('-n', '--vertices', dest='vertices',
+                  help='Intermediate vertices per cell edge when no input file is given, default %default',
+                  type='int')
+
+parser.add_option('-t', '--tolerance', dest='tolerance',
+                  help='Tolerance to simplify to before saving, default %default',
+                  type='float')
+
+parser.add_option('-p', '--precision', dest='precision',
+                  help='Decimal places for the rounded outputs, default %default',
+                  type='int')
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+    directory = mkdtemp(prefix='bloch-output-')
+    
+    try:
+        if args:
+            filename = args[0]
+        
+        else:
+            filename = join(directory, 'input.json')
+            write_geojson(voronoi_coverage(opts.features, opts.vertices), filename)
+        
+        start = time()
+        datasource = load(filename)
+        datasource.simplify(opts.tolerance)
+        print 'Loaded and simplified %s in %.3fs' % (filename, time() - start)
+        
+        for precision in (None, opts.precision):
+            for ext in ('.json', '.geojson', '.ndjson'):
+                outfile = join(directory, 'output-%s%s' % (precision, ext))
+                
+                start = time()
+                stats = save(datasource, outfile, precision=precision)
+                elapsed = time() - start
+                
+                features = stats.get('stitched', 0) + stats.get('polygonized', 0)
+                writer = 'native' if ext in geojson_formats else 'OGR'
+                
+                print '%8s %6s %4s places: %.3fs, %.0f features/sec, %.1f MB' \
+                    % (ext, writer, 'all' if precision is None else precision,
+                       elapsed, features / elapsed, getsize(outfile) / 1048576.)
+    
+    finally:
+        rmtree(directory)
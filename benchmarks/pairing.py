@@ -0,0 +1,55 @@
+""" Compare load() time for each shared border pairing strategy.
+
+Generates square grid coverages of increasing feature counts, loads each
+with every strategy in Bloch.pairings, and checks that the segment tables
+are identical.
+"""
+
+from os import close, unlink
+from time import time
+from tempfile import mkstemp
+from optparse import OptionParser
+
+from Bloch import load, pairings
+from benchmarks.synthetic import grid_coverage, write_geojson
+
+parser = OptionParser(usage="""%prog [options] <feature count> [<feature count>]+
+
+Example:
+
+  python -m benchmarks.pairing 100 400 1600""")
+
+parser.set_defaults(vertices=4)
+
+parser.add_option('-n', '--vertices', dest='vertices',
+                  help='Intermediate vertices per grid edge, default %default',
+                  type='int')
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+    
+    names = sorted(pairings)
+    
+    print '%8s' % 'features', ' '.join(['%12s' % name for name in names]), 'identical'
+    
+    for count in map(int, args):
+        side = max(1, int(round(count ** .5)))
+        
+        handle, filename = mkstemp(suffix='.json')
+        close(handle)
+        
+        write_geojson([[ring] for ring in grid_coverage(side, side, opts.vertices)], filename)
+        
+        times, tables = [], []
+        
+        for name in names:
+            start = time()
+            datasource = load(filename, pairing=name)
+            times.append(time() - start)
+            tables.append(datasource.segments.rows())
+        
+        unlink(filename)
+        
+        identical = len([table for table in tables if table != tables[0]]) == 0
+        
+        print '%8d' % (side * side), ' '.join(['%11.3fs' % t for t in times]), identical and 'yes' or 'NO'
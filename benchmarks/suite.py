@@ -0,0 +1,183 @@
+""" Baseline timings, memory and output checks on synthetic tessellations.
+
+Generates Voronoi coverages of each requested feature count, then loads,
+simplifies and saves each one at every tolerance through the public API.
+Each coverage is processed in its own process so peak memory is measured
+separately, and doesn't include generating the coverage.
+Outputs are read back to count vertices and check that polygons are valid,
+that no two features overlap, and how much total area has changed.
+"""
+
+from time import time
+from shutil import rmtree
+from os.path import join, dirname
+from tempfile import mkdtemp
+from optparse import OptionParser
+from multiprocessing import Process, Pipe
+from resource import getrusage, RUSAGE_SELF
+from json import dump
+
+from osgeo import ogr
+from rtree import Rtree
+from shapely.wkb import loads
+from shapely.geometry import Polygon
+
+from Bloch import load, save
+from benchmarks.synthetic import voronoi_coverage, write_geojson
+
+parser = OptionParser(usage="""%prog [options] <feature count> [<feature count>]+
+
+Tolerances are in map units, where an average feature is about one unit square.
+
+Example:
+
+  python -m benchmarks.suite -t .05 -t .2 --json baseline.json 100 1000 10000""")
+
+parser.set_defaults(vertices=4, holes=10, seed=0, tolerances=[], builder='overlay', store='sqlite', workers=None)
+
+parser.add_option('-n', '--vertices', dest='vertices',
+                  help='Intermediate vertices per cell edge, default %default',
+                  type='int')
+
+parser.add_option('--holes', dest='holes',
+                  help='Number of features with holes, half of them filled by islands, default %default',
+                  type='int')
+
+parser.add_option('--seed', dest='seed',
+                  help='Random seed for the coverages, default %default',
+                  type='int')
+
+parser.add_option('-t', '--tolerance', dest='tolerances',
+                  help='Tolerance to simplify to, may be given more than once, default .05 and .2',
+                  type='float', action='append')
+
+parser.add_option('-a', '--arcs', dest='builder',
+                  help='Find borders by matching vertices instead of intersecting shapes',
+                  action='store_const', const='arcs')
+
+parser.add_option('-s', '--store', dest='store',
+                  help='Segment store, "sqlite" (default) or "array"',
+                  type='choice', choices=('sqlite', 'array'))
+
+parser.add_option('-w', '--workers', dest='workers',
+                  help='Number of processes for simplifying lines',
+                  type='int')
+
+parser.add_option('--json', dest='json',
+                  help='File to write all results to as JSON, to compare with later runs',
+                  metavar='FILE')
+
+def run_coverage(task):
+    """ Load, simplify and save one coverage file, return a dictionary of results.
+    
+        Outputs are written next to the input file.
+    """
+    infile, features, area, opts = task
+    directory = dirname(infile)
+    
+    start = time()
+    datasource = load(infile, builder=opts.builder, store=opts.store)
+    result = dict(load_seconds=time() - start, load=datasource.stats['load'], tolerances=[])
+    
+    for tolerance in sorted(opts.tolerances):
+        outfile = join(directory, 'output-%s.json' % tolerance)
+        
+        start = time()
+        simplify_stats = datasource.simplify(tolerance, workers=opts.workers)
+        simplify_seconds = time() - start
+        
+        start = time()
+        save_stats = save(datasource, outfile)
+        save_seconds = time() - start
+        
+        result['tolerances'].append(dict(tolerance=tolerance, outfile=outfile,
+                                         simplify_seconds=simplify_seconds, simplify=simplify_stats,
+                                         save_seconds=save_seconds, save=save_stats))
+    
+    # checks below read the outputs back, so peak memory is taken first.
+    result['peak_mb'] = getrusage(RUSAGE_SELF).ru_maxrss / 1024.
+    
+    for run in result['tolerances']:
+        run.update(check_output(run.pop('outfile'), features, area))
+    
+    return result
+
+def send_coverage(connection, task):
+    """ Send the results of run_coverage() back through a connection from Pipe().
+    """
+    connection.send(run_coverage(task))
+    connection.close()
+
+def check_output(filename, features, area):
+    """ Read a saved file back, return a dictionary of vertex counts and topology checks.
+    """
+    source = ogr.Open(filename)
+    shapes = [loads(feature.geometry().ExportToWkb()) for feature in source.GetLayer(0)]
+    
+    polygons = [polygon for shape in shapes for polygon in (hasattr(shape, 'geoms') and shape.geoms or [shape])]
+    vertices = sum([len(ring.coords) for polygon in polygons for ring in [polygon.exterior] + list(polygon.interiors)])
+    
+    invalid = [i for (i, shape) in enumerate(shapes) if not shape.is_valid]
+    valid = [(i, shape) for (i, shape) in enumerate(shapes) if shape.is_valid]
+    
+    rtree = Rtree([(i, shape.bounds, None) for (i, shape) in valid]) if valid else Rtree()
+    overlaps = 0
+    
+    for (i, shape) in valid:
+        for j in rtree.intersection(shape.bounds):
+            if j > i and shape.intersection(shapes[j]).area > area * 1e-9:
+                overlaps += 1
+    
+    output_area = sum([shape.area for shape in shapes])
+    
+    return dict(features=len(shapes), missing=features - len(shapes), vertices=vertices,
+                invalid=len(invalid), overlaps=overlaps, area_change=(output_area - area) / area)
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+    opts.tolerances = opts.tolerances or [.05, .2]
+    
+    results = []
+    
+    print '%8s %9s %8s %8s %8s %9s %8s %8s %7s %8s %10s' % ('features', 'tolerance', 'load', 'simplify', 'save',
+                                                            'vertices', 'peak MB', 'missing', 'invalid', 'overlaps', 'area')
+    
+    for count in map(int, args):
+        directory = mkdtemp(prefix='bloch-suite-')
+        
+        try:
+            start = time()
+            polygons = voronoi_coverage(count, opts.vertices, opts.holes, opts.seed)
+            infile = join(directory, 'input.json')
+            write_geojson(polygons, infile)
+            
+            result = dict(count=count, features=len(polygons), generate_seconds=time() - start,
+                          vertices=sum([len(ring) for rings in polygons for ring in rings]),
+                          area=sum([Polygon(rings[0], rings[1:]).area for rings in polygons]))
+            
+            del polygons
+            
+            # a fresh process for each size keeps peak memory from carrying over,
+            # and isn't a pool worker so simplify() can start its own workers.
+            connection, child_connection = Pipe()
+            process = Process(target=send_coverage, args=(child_connection, (infile, result['features'], result['area'], opts)))
+            process.start()
+            child_connection.close()
+            result.update(connection.recv())
+            process.join()
+        
+        finally:
+            rmtree(directory)
+        
+        results.append(result)
+        
+        for run in result['tolerances']:
+            print '%8d %9s %7.3fs %7.3fs %7.3fs %9d %8.1f %8d %7d %8d %+9.4f%%' \
+                % (result['features'], run['tolerance'], result['load_seconds'], run['simplify_seconds'],
+                   run['save_seconds'], run['vertices'], result['peak_mb'], run['missing'],
+                   run['invalid'], run['overlaps'], run['area_change'] * 100)
+    
+    if opts.json:
+        dump(dict(options=dict(vertices=opts.vertices, holes=opts.holes, seed=opts.seed,
+                               builder=opts.builder, store=opts.store, workers=opts.workers), results=results),
+             open(opts.json, 'w'), indent=2)
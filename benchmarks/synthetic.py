@@ -0,0 +1,240 @@
+""" Generate synthetic polygon coverages for benchmarks.
+"""
+
+from json import dump
+from random import Random
+
+from shapely.geometry import Polygon
+
+def grid_coverage(columns, rows, vertices=4, jitter=.3, seed=0):
+    """ Return a list of polygon rings tiling a grid of jittered quadrilaterals.
+    
+        Each edge between grid nodes gets the given number of intermediate
+        vertices with a little noise, and edges are generated once so that
+        neighboring features share them exactly. Nodes along the outside of
+        the grid are left in place so the coverage has a straight border.
+    """
+    random = Random(seed)
+    nodes, edges = {}, {}
+    
+    for x in range(columns + 1):
+        for y in range(rows + 1):
+            if x in (0, columns) or y in (0, rows):
+                nodes[(x, y)] = float(x), float(y)
+            else:
+                nodes[(x, y)] = x + random.uniform(-jitter, jitter), y + random.uniform(-jitter, jitter)
+    
+    def edge(node1, node2):
+        key = min(node1, node2), max(node1, node2)
+        
+        if key not in edges:
+            (x1, y1), (x2, y2) = nodes[key[0]], nodes[key[1]]
+            points = [nodes[key[0]]]
+            
+            for k in range(1, vertices + 1):
+                f, noise = float(k) / (vertices + 1), .05 / (vertices + 1)
+                points.append((x1 + (x2 - x1) * f + random.uniform(-noise, noise),
+                               y1 + (y2 - y1) * f + random.uniform(-noise, noise)))
+            
+            edges[key] = points + [nodes[key[1]]]
+        
+        return (key[0] == node1) and edges[key] or edges[key][::-1]
+    
+    rings = []
+    
+    for x in range(columns):
+        for y in range(rows):
+            corners = [(x, y), (x + 1, y), (x + 1, y + 1), (x, y + 1), (x, y)]
+            ring = []
+            
+            for (node1, node2) in zip(corners[:-1], corners[1:]):
+                ring.extend(edge(node1, node2)[:-1])
+            
+            rings.append(ring + ring[:1])
+    
+    return rings
+
+def voronoi_coverage(count, vertices=4, holes=0, seed=0):
+    """ Return a list of polygons, each a list of rings, tiling a square with
+        the Voronoi cells of count random seed points.
+    
+        Each cell is the bounding square clipped by the half-planes closer to
+        its seed than to any nearby seed. Corners are computed once from the
+        seeds or square edges that meet there, and edges between corners get
+        the given number of intermediate vertices with a little noise, so
+        neighboring features share them exactly. Noise can make a cell with
+        a very sharp corner cross itself, so the edges of any such cell are
+        straightened. The first holes cells get a hole around their seed,
+        and every other hole is filled by an extra island feature appended
+        to the list.
+    """
+    random = Random(seed)
+    side = count ** .5
+    seeds = [(random.uniform(0, side), random.uniform(0, side)) for i in range(count)]
+    
+    # seeds are bucketed by unit cell to find neighbors in growing rings.
+    buckets = {}
+    
+    for (i, (x, y)) in enumerate(seeds):
+        buckets.setdefault((int(x), int(y)), []).append(i)
+    
+    corners, edges = {}, {}
+    
+    def corner(i, label1, label2):
+        """ Return the key and point where two cell edges meet.
+        
+            Labels are ('square', side number) for edges of the bounding square
+            or ('seed', index) for the bisector between seed i and another.
+        """
+        labels = sorted([label1, label2])
+        
+        if labels[0][0] == labels[1][0] == 'square':
+            key = ('square', labels[0][1], labels[1][1])
+        elif labels[0][0] == 'seed' and labels[1][0] == 'seed':
+            key = ('seeds', ) + tuple(sorted([i, labels[0][1], labels[1][1]]))
+        else:
+            j = labels[0][1]
+            key = ('edge', labels[1][1], min(i, j), max(i, j))
+        
+        if key not in corners:
+            corners[key] = corner_point(key, seeds, side)
+        
+        return key
+    
+    def clip(i, labels, j):
+        """ Clip a cell, as a list of edge labels, to the side of seed i away from seed j.
+        """
+        (xi, yi), (xj, yj) = seeds[i], seeds[j]
+        points = [corners[corner(i, labels[k - 1], labels[k])] for k in range(len(labels))]
+        inside = [(x - xi) ** 2 + (y - yi) ** 2 <= (x - xj) ** 2 + (y - yj) ** 2 for (x, y) in points]
+        clipped = []
+        
+        for k in range(len(labels)):
+            here, there = inside[k], inside[(k + 1) % len(labels)]
+            
+            if here or there:
+                clipped.append(labels[k])
+            
+            if here and not there:
+                clipped.append(('seed', j))
+        
+        return clipped
+    
+    cells = []
+    
+    for (i, (x, y)) in enumerate(seeds):
+        labels = [('square', 0), ('square', 1), ('square', 2), ('square', 3)]
+        bx, by, reach = int(x), int(y), 0
+        
+        while True:
+            # every seed within reach units has been clipped against.
+            ring = [(bx + dx, by + dy) for dx in range(-reach, reach + 1) for dy in range(-reach, reach + 1)
+                    if max(abs(dx), abs(dy)) == reach]
+            
+            for j in [j for bucket in ring for j in buckets.get(bucket, []) if j != i]:
+                labels = clip(i, labels, j)
+            
+            points = [corners[corner(i, labels[k - 1], labels[k])] for k in range(len(labels))]
+            radius = max([((px - x) ** 2 + (py - y) ** 2) ** .5 for (px, py) in points])
+            
+            if 2 * radius <= reach or reach > side + 1:
+                break
+            
+            reach += 1
+        
+        cells.append([corner(i, labels[k - 1], labels[k]) for k in range(len(labels))])
+    
+    def edge(key1, key2, straight=False):
+        key = min(key1, key2), max(key1, key2)
+        
+        if straight:
+            (x1, y1), (x2, y2) = corners[key[0]], corners[key[1]]
+            edges[key] = [(x1 + (x2 - x1) * k / (vertices + 1.), y1 + (y2 - y1) * k / (vertices + 1.))
+                          for k in range(vertices + 2)]
+        
+        if key not in edges:
+            (x1, y1), (x2, y2) = corners[key[0]], corners[key[1]]
+            points = [corners[key[0]]]
+            
+            # edges along the bounding square are left straight.
+            noise = 0 if (key[0][0] != 'seeds' and key[1][0] != 'seeds') else .1 / (vertices + 1)
+            
+            for k in range(1, vertices + 1):
+                f, offset = float(k) / (vertices + 1), random.uniform(-noise, noise)
+                points.append((x1 + (x2 - x1) * f - (y2 - y1) * offset,
+                               y1 + (y2 - y1) * f + (x2 - x1) * offset))
+            
+            edges[key] = points + [corners[key[1]]]
+        
+        return (key[0] == key1) and edges[key] or edges[key][::-1]
+    
+    def cell_ring(keys, straight=False):
+        ring = []
+        
+        for (key1, key2) in zip(keys, keys[1:] + keys[:1]):
+            ring.extend(edge(key1, key2, straight)[:-1])
+        
+        return ring + ring[:1]
+    
+    rings = [cell_ring(keys) for keys in cells]
+    crossed = [i for (i, ring) in enumerate(rings) if not Polygon(ring).is_valid]
+    
+    while crossed:
+        for i in crossed:
+            cell_ring(cells[i], True)
+        
+        # straightened edges are shared, so neighbors are rebuilt too.
+        rings = [cell_ring(keys) for keys in cells]
+        crossed = [i for (i, ring) in enumerate(rings) if not Polygon(ring).is_valid]
+    
+    polygons, islands = [[ring] for ring in rings], []
+    
+    for i in range(len(cells)):
+        if i < holes:
+            (x, y), shell = seeds[i], polygons[i][0]
+            hole = [(x + (px - x) / 4, y + (py - y) / 4) for (px, py) in reversed(shell)]
+            polygons[i].append(hole)
+            
+            if i % 2 == 0:
+                islands.append([hole[::-1]])
+    
+    return polygons + islands
+
+def corner_point(key, seeds, side):
+    """ Return the point for a corner key from voronoi_coverage().
+    
+        Points are computed from sorted seed indexes, so every cell that
+        shares a corner gets exactly the same coordinates for it.
+    """
+    if key[0] == 'square':
+        return {(0, 1): (side, 0.), (1, 2): (side, side), (2, 3): (0., side), (0, 3): (0., 0.)}[key[1:]]
+    
+    if key[0] == 'edge':
+        (px, py), (qx, qy) = seeds[key[2]], seeds[key[3]]
+        
+        # points on the bisector satisfy a * x + b * y = c.
+        a, b, c = 2 * (qx - px), 2 * (qy - py), qx ** 2 + qy ** 2 - px ** 2 - py ** 2
+        
+        if key[1] in (0, 2):
+            y = (key[1] == 2) and side or 0.
+            return (c - b * y) / a, y
+        
+        x = (key[1] == 1) and side or 0.
+        return x, (c - a * x) / b
+    
+    (ax, ay), (bx, by), (cx, cy) = [seeds[i] for i in key[1:]]
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    
+    x = ((ax ** 2 + ay ** 2) * (by - cy) + (bx ** 2 + by ** 2) * (cy - ay) + (cx ** 2 + cy ** 2) * (ay - by)) / d
+    y = ((ax ** 2 + ay ** 2) * (cx - bx) + (bx ** 2 + by ** 2) * (ax - cx) + (cx ** 2 + cy ** 2) * (bx - ax)) / d
+    
+    return x, y
+
+def write_geojson(polygons, filename):
+    """ Write a list of polygons, each a list of rings, to a GeoJSON file.
+    """
+    features = [{'type': 'Feature', 'properties': {'id': i},
+                 'geometry': {'type': 'Polygon', 'coordinates': rings}}
+                for (i, rings) in enumerate(polygons)]
+    
+    dump({'type': 'FeatureCollection', 'features': features}, open(filename, 'w'))
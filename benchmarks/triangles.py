@@ -0,0 +1,73 @@
+""" Compare triangle area computation with shapely polygons and NumPy.
+
+Builds lines from the rings of a synthetic grid coverage, then computes the
+area of every vertex triangle the way simplify() once did, with a Polygon
+per triangle, and with one batched Bloch.triangle_areas() call per line.
+"""
+
+from time import time
+from optparse import OptionParser
+
+import numpy
+from shapely.geometry import Polygon
+
+from Bloch import triangle_areas
+from benchmarks.synthetic import grid_coverage
+
+parser = OptionParser(usage="""%prog [options]
+
+Example:
+
+  python -m benchmarks.triangles --features 2500 --vertices 20""")
+
+parser.set_defaults(features=1000, vertices=10, repeat=3)
+
+parser.add_option('-f', '--features', dest='features',
+                  help='Number of features in the coverage, default %default',
+                  type='int')
+
+parser.add_option('-n', '--vertices', dest='vertices',
+                  help='Intermediate vertices per grid edge, default %default',
+                  type='int')
+
+parser.add_option('-r', '--repeat', dest='repeat',
+                  help='Number of timed runs to take the best of, default %default',
+                  type='int')
+
+def polygon_areas(segments):
+    triples = [(segments[k][:2], segments[k][2:], segments[k+1][2:]) for k in range(len(segments) - 1)]
+    return [Polygon([c1, c2, c3, c1]).area for (c1, c2, c3) in triples]
+
+def numpy_areas(segments):
+    return triangle_areas(numpy.array(segments, numpy.float64)).tolist()
+
+def best_time(function, lines, repeat):
+    times = []
+    
+    for i in range(repeat):
+        start = time()
+        results = map(function, lines)
+        times.append(time() - start)
+    
+    return min(times), results
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+    
+    side = max(1, int(round(opts.features ** .5)))
+    lines = []
+    
+    for ring in grid_coverage(side, side, opts.vertices):
+        lines.append([ring[k] + ring[k+1] for k in range(len(ring) - 1)])
+    
+    count = sum([len(line) - 1 for line in lines])
+    
+    polygon_time, polygon_results = best_time(polygon_areas, lines, opts.repeat)
+    numpy_time, numpy_results = best_time(numpy_areas, lines, opts.repeat)
+    
+    error = max([abs(a - b) for (line1, line2) in zip(polygon_results, numpy_results) for (a, b) in zip(line1, line2)])
+    
+    print '%d lines, %d triangles' % (len(lines), count)
+    print 'Polygon: %.3fs, %.0f triangles/sec' % (polygon_time, count / polygon_time)
+    print 'NumPy:   %.3fs, %.0f triangles/sec' % (numpy_time, count / numpy_time)
+    print 'Speedup: %.1fx, largest difference %g' % (polygon_time / numpy_time, error)
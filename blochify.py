@@ -1,8 +1,11 @@
 #!/usr/bin/env python
-from sys import stderr
+from sys import stderr, exit
+from json import dump
+from os.path import splitext
 from optparse import OptionParser
+from multiprocessing import Pool
 
-from Bloch import load, save
+from Bloch import load, save, dump_topology, load_topology, topology_matches, simplify_partitioned
 
 parser = OptionParser(usage="""%prog <input file> <tolerance> <output file> [<tolerance> <output file>]+
 
@@ -10,38 +13,199 @@ Example:
 
   %prog counties.shp 500 counties-simple.shp 5000 counties-simpler.shp
 
+With more than one input file, each output file is written once per input,
+named for it, e.g. simple-states.shp and simple-counties.shp from:
+
+  %prog -a -i counties.shp states.shp 500 simple.shp
+
 That is all.""")
 
-parser.set_defaults()
+parser.set_defaults(workers=None, writers=1, store='sqlite', memo_size=65536, builder='overlay')
 
 parser.add_option('-v', '--verbose', dest='verbose',
                   help='Be louder than normal',
                   action='store_true')
 
+parser.add_option('-r', '--rank', dest='rank',
+                  help='Rank vertices once to the largest tolerance, then write each output from that ranking',
+                  action='store_true')
+
+parser.add_option('-w', '--workers', dest='workers',
+                  help='Number of processes for finding borders while loading and for simplifying lines, or for partitions with --tiles',
+                  type='int')
+
+parser.add_option('-W', '--writers', dest='writers',
+                  help='Number of background processes saving output files while simplification goes on, default %default, or 0 to save each file before going on',
+                  type='int')
+
+parser.add_option('-T', '--tiles', dest='tiles',
+                  help='Simplify in a grid of COLUMNSxROWS partitions to save memory, e.g. 4x4',
+                  metavar='COLUMNSxROWS')
+
+parser.add_option('-s', '--store', dest='store',
+                  help='Segment store, "sqlite" (default) or "array"',
+                  type='choice', choices=('sqlite', 'array'))
+
+parser.add_option('-m', '--memo-size', dest='memo_size',
+                  help='Number of line strings to keep in memory while saving, default %default',
+                  type='int')
+
+parser.add_option('-a', '--arcs', dest='builder',
+                  help='Find borders by matching vertices instead of intersecting shapes',
+                  action='store_const', const='arcs')
+
+parser.add_option('-q', '--quantize', dest='quantize',
+                  help='Grid size in map units to snap coordinates to before finding borders, or "auto" for a tenth of the smallest tolerance',
+                  metavar='SIZE')
+
+parser.add_option('-t', '--topology', dest='topology',
+                  help='Topology file to reuse if the input file is unchanged, or to write after loading',
+                  metavar='FILE')
+
+parser.add_option('-i', '--input', dest='inputs',
+                  help='Another input file to share borders with, may be given more than once',
+                  action='append', metavar='FILE')
+
+parser.add_option('-p', '--precision', dest='precision',
+                  help='Decimal places to round coordinates to in GeoJSON output (.json, .geojson, .geojsonl or .ndjson)',
+                  type='int')
+
+parser.add_option('--stats', dest='stats',
+                  help='JSON file to write counters and timings for each phase to',
+                  metavar='FILE')
+
+def layer_outfiles(outfile, layers):
+    """ Return an output filename for each layer, named for the layer if there are several.
+    """
+    if len(layers) == 1:
+        return [outfile]
+    
+    base, ext = splitext(outfile)
+    return ['%s-%s%s' % (base, layer.name, ext) for layer in layers]
+
+def save_layers(task):
+    """ Save every layer of a datasource or snapshot.
+    
+        Returns a list of stats for each layer, and line cache stats.
+    """
+    datasource, outfile, tolerance, precision = task
+    
+    saves = [save(datasource, layer_outfile, tolerance, layer=k, precision=precision)
+             for (k, layer_outfile) in enumerate(layer_outfiles(outfile, datasource.layers))]
+    
+    return saves, datasource.memo_line.stats()
+
 if __name__ == '__main__':
     opts, args = parser.parse_args()
     
     infile, outargs = args[0], args[1:]
     outfiles = [(int(outargs[i]), outargs[i + 1]) for i in range(0, len(outargs), 2)]
     
-    if opts.verbose:
-        print >> stderr, 'Loading data...'
-
-    datasource = load(infile, opts.verbose)
+    if opts.inputs:
+        if opts.tiles:
+            parser.error('--tiles works with only one input file')
+        
+        infile = [infile] + opts.inputs
+    
+    if opts.quantize == 'auto':
+        quantize = min(outfiles)[0] / 10.
+    
+    else:
+        quantize = opts.quantize and float(opts.quantize)
+    
+    if opts.tiles:
+        tiles = tuple(map(int, opts.tiles.lower().split('x')))
+        
+        partitions = simplify_partitioned(infile, outfiles, tiles, opts.workers, opts.verbose, opts.precision,
+                                          store=opts.store, memo_size=opts.memo_size, builder=opts.builder, quantize=quantize)
+        
+        if opts.stats:
+            dump(dict(partitions=partitions), open(opts.stats, 'w'), indent=2)
+        
+        exit()
+    
+    if opts.topology and topology_matches(opts.topology, infile, opts.builder, quantize):
+        if opts.verbose:
+            print >> stderr, 'Reading topology from %s...' % opts.topology
+        
+        datasource = load_topology(opts.topology, opts.store, opts.memo_size)
+    
+    else:
+        if opts.verbose:
+            print >> stderr, 'Loading data...'
+    
+        datasource = load(infile, opts.verbose, workers=opts.workers, store=opts.store, memo_size=opts.memo_size, builder=opts.builder, quantize=quantize)
+        
+        if opts.topology:
+            if opts.verbose:
+                print >> stderr, 'Writing topology to %s...' % opts.topology
+            
+            dump_topology(datasource, opts.topology, infile)
     
     if opts.verbose:
         print >> stderr, len(datasource._indexes()), 'shapes,',
-        print >> stderr, datasource.db.execute('SELECT COUNT(DISTINCT line_id) FROM segments').fetchone()[0], 'lines,',
-        print >> stderr, datasource.db.execute('SELECT COUNT(DISTINCT guid) FROM segments').fetchone()[0], 'segments.'
+        print >> stderr, datasource.segments.count_lines(), 'lines,',
+        print >> stderr, datasource.segments.count(), 'segments.'
+    
+    stats = dict(load=datasource.stats['load'], simplify=[], save=[])
+    
+    # Each output is saved from a snapshot of its lines in a writer process,
+    # or directly from the datasource if there are no writers.
+    writers = opts.writers and Pool(opts.writers) or None
+    writes = []
     
-    for (tolerance, outfile) in sorted(outfiles):
+    if opts.rank:
     
         if opts.verbose:
-            print >> stderr, 'Simplifying linework to %d...' % tolerance
+            print >> stderr, 'Ranking linework to %d...' % max(outfiles)[0]
 
-        datasource.simplify(tolerance, opts.verbose)
+        stats['rank'] = datasource.rank(max(outfiles)[0], opts.verbose)
         
-        if opts.verbose:
-            print >> stderr, 'Building %s...' % outfile
+        for (tolerance, outfile) in outfiles:
+        
+            if opts.verbose:
+                print >> stderr, 'Building %s at %d...' % (outfile, tolerance)
+    
+            if writers is None:
+                stats['save'].extend(save_layers((datasource, outfile, tolerance, opts.precision))[0])
+            else:
+                writes.append(writers.apply_async(save_layers, ((datasource.snapshot(tolerance), outfile, tolerance, opts.precision), )))
+    
+    else:
+        for (tolerance, outfile) in sorted(outfiles):
+        
+            if opts.verbose:
+                print >> stderr, 'Simplifying linework to %d...' % tolerance
+
+            stats['simplify'].append(datasource.simplify(tolerance, opts.verbose, opts.workers))
+            
+            if opts.verbose:
+                print >> stderr, 'Building %s...' % outfile
 
-        save(datasource, outfile)
+            if writers is None:
+                stats['save'].extend(save_layers((datasource, outfile, None, opts.precision))[0])
+            else:
+                writes.append(writers.apply_async(save_layers, ((datasource.snapshot(), outfile, None, opts.precision), )))
+    
+    if writers is None:
+        stats['line_cache'] = datasource.memo_line.stats()
+    
+    else:
+        # each snapshot has a line cache of its own in a writer process.
+        stats['line_cache'] = dict(hits=0, misses=0, evictions=0, size=0, limit=datasource.memo_line.size)
+        
+        for write in writes:
+            saves, line_cache = write.get()
+            stats['save'].extend(saves)
+            
+            for key in ('hits', 'misses', 'evictions', 'size'):
+                stats['line_cache'][key] += line_cache[key]
+        
+        writers.close()
+        writers.join()
+    
+    if opts.verbose:
+        print >> stderr, 'Line cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions.' % stats['line_cache']
+    
+    if opts.stats:
+        dump(stats, open(opts.stats, 'w'), indent=2)
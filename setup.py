@@ -10,7 +10,7 @@ setup(name='Bloch',
       author='Michal Migurski',
       author_email='mike@stamen.com',
       url='http://github.com/migurski/Bloch',
-      requires=['ModestMaps'],
+      requires=['ModestMaps', 'numpy'],
       packages=['Bloch'],
       scripts=['blochify.py'],
       license='BSD')
@@ -0,0 +1,171 @@
+""" Check that snapping to a grid brings near-coincident borders together.
+
+Coverages are built with every feature's copy of a shared border moved
+independently by less than a cell, so borders only match after snapping.
+Datasources are built straight from shapely shapes without OGR.
+
+Run with:
+
+  python -m unittest discover tests
+"""
+import unittest
+from random import Random
+
+from rtree import Rtree
+from shapely.wkb import dumps
+from shapely.geometry import Polygon, MultiPolygon
+
+from Bloch import Datasource, WKBShapes, HotPixels, pairings, populate_unshared_segments, populate_arcs, flush_lines, feature_polygons, make_grid, snap_wkbs
+
+def make_shapes(size=4, seed=0):
+    """ Return a list of shapes in a size by size coverage of wiggly squares.
+        
+        Shared corners and border wiggles are random, and then each shape's
+        copy of every vertex is moved by up to .15 in each direction. The
+        first shape has a hole with an island too small to survive a grid
+        of size one in it, which is the last shape.
+    """
+    random = Random(seed)
+    corners = dict([((i, j), (i * 10 + random.uniform(-2, 2), j * 10 + random.uniform(-2, 2)))
+                    for i in range(size + 1) for j in range(size + 1)])
+    
+    def border(start, end):
+        (x1, y1), (x2, y2) = corners[start], corners[end]
+        points = [(x1, y1)]
+        
+        for k in range(1, 8):
+            wiggle = random.uniform(-1, 1)
+            points.append((x1 + (x2 - x1) * k / 8. - (y2 - y1) * wiggle / 10, y1 + (y2 - y1) * k / 8. + (x2 - x1) * wiggle / 10))
+        
+        return points + [(x2, y2)]
+    
+    borders = {}
+    
+    for i in range(size + 1):
+        for j in range(size + 1):
+            if i < size:
+                borders[(i, j), (i + 1, j)] = border((i, j), (i + 1, j))
+            if j < size:
+                borders[(i, j), (i, j + 1)] = border((i, j), (i, j + 1))
+    
+    def copy(points):
+        return [(x + random.uniform(-.15, .15), y + random.uniform(-.15, .15)) for (x, y) in points]
+    
+    island = [(4.3, 4.3), (4.7, 4.3), (4.7, 4.7), (4.3, 4.7), (4.3, 4.3)]
+    shapes = []
+    
+    for i in range(size):
+        for j in range(size):
+            ring = borders[(i, j), (i + 1, j)][:-1] + borders[(i + 1, j), (i + 1, j + 1)][:-1] \
+                 + borders[(i, j + 1), (i + 1, j + 1)][:0:-1] + borders[(i, j), (i, j + 1)][:0:-1]
+            shell = copy(ring)
+            shapes.append(Polygon(shell + shell[:1], [island[::-1]] if (i, j) == (0, 0) else []))
+    
+    return shapes + [Polygon(island)]
+
+def make_datasource(shapes, store, builder, quantize=1):
+    """ Return a new Datasource for a list of shapes snapped to a grid, with segments.
+    """
+    xs = [x for shape in shapes for x in shape.bounds[0::2]]
+    ys = [y for shape in shapes for y in shape.bounds[1::2]]
+    grid = make_grid(quantize, [(min(xs), max(xs), min(ys), max(ys))])
+    
+    wkbs = map(dumps, shapes)
+    collapsed = snap_wkbs(grid, wkbs)
+    
+    areas = [shape.area for shape in shapes]
+    datasource = Datasource(None, None, [], [[] for shape in shapes], WKBShapes(wkbs), store, areas=areas, grid=grid)
+    datasource.collapsed = collapsed
+    
+    if builder == 'arcs':
+        populate_arcs(datasource)
+    
+    else:
+        shared_borders = pairings['rtree'](datasource)
+        populate_unshared_segments(datasource, shared_borders)
+    
+    flush_lines(datasource)
+    
+    return datasource
+
+class GridTests(unittest.TestCase):
+    
+    def test_clusters(self):
+        grid = make_grid(1, [(0, 10, 0, 10)])
+        
+        # copies of a vertex on either side of a cell edge meet in one cell.
+        clusters = grid.clusters([(3.45, 2.1), (3.55, 2.15), (6, 6)])
+        self.assertEqual(clusters[(3.45, 2.1)], clusters[(3.55, 2.15)])
+        self.assertFalse((6, 6) in clusters)
+        
+        # a densely digitized line is split into pairs, not pulled into a single cell.
+        line = [(x * .6 + dx, 5.) for x in range(8) for dx in (0, .2)]
+        self.assertTrue(len(set(grid.clusters(line).values())) > 3)
+    
+    def test_hot_pixels(self):
+        pixels = HotPixels([(0, 0), (4, 1), (2, 0), (8, 0)])
+        
+        self.assertEqual(pixels.crossed((0, 0), (8, 0)), [(2, 0)])
+        self.assertEqual(pixels.bend([(0, 0), (8, 2)]), [(0, 0), (2, 0), (4, 1), (8, 2)])
+    
+    def test_repair(self):
+        grid = make_grid(1, [(0, 10, 0, 10)])
+        
+        # a shell snapped into a figure eight keeps the lobe that winds counterclockwise.
+        repaired = grid.repair(Polygon([(0, 0), (4, 0), (0, 4), (4, 4), (0, 0)]))
+        self.assertTrue(repaired.is_valid)
+        self.assertEqual(repaired.area, 4)
+
+class SnapTests(unittest.TestCase):
+    
+    def check_snap(self, store, builder):
+        shapes = make_shapes()
+        datasource = make_datasource(shapes, store, builder)
+        
+        # the island snaps to nothing, and takes its hole with it.
+        self.assertEqual(datasource.collapsed, set([len(shapes) - 1]))
+        
+        neighbors, unshared = set(), set()
+        
+        for (line_id, src1_id, src2_id, points) in datasource.lines():
+            if src2_id is None:
+                unshared.update([src1_id] + datasource.owners.get(line_id, []))
+            else:
+                neighbors.add((min(src1_id, src2_id), max(src1_id, src2_id)))
+        
+        # both copies of every border came together as one line.
+        expected = [(i * 4 + j, i * 4 + j + 1) for i in range(4) for j in range(3)] \
+                 + [(i * 4 + j, i * 4 + j + 4) for i in range(3) for j in range(4)]
+        
+        self.assertTrue(neighbors.issuperset(expected))
+        self.assertFalse(unshared & set([5, 6, 9, 10]))
+        
+        for tolerance in (0, .2, 2):
+            datasource.simplify(tolerance)
+            self.assertPolygonsFit(datasource, len(shapes) - 1)
+    
+    def assertPolygonsFit(self, datasource, count):
+        shapes = [MultiPolygon([Polygon(shell, holes) for (shell, holes) in polygons])
+                  for (i, polygons) in feature_polygons(datasource)]
+        
+        self.assertEqual(len(shapes), count)
+        self.assertTrue(all([shape.is_valid for shape in shapes]))
+        
+        rtree = Rtree([(k, shape.bounds, None) for (k, shape) in enumerate(shapes)])
+        
+        for (k, shape) in enumerate(shapes):
+            for other in rtree.intersection(shape.bounds):
+                if other > k:
+                    self.assertTrue(shape.intersection(shapes[other]).area < 1e-9)
+    
+    def test_sqlite_overlay(self):
+        self.check_snap('sqlite', 'overlay')
+    
+    def test_array_overlay(self):
+        self.check_snap('array', 'overlay')
+    
+    def test_array_arcs(self):
+        self.check_snap('array', 'arcs')
+
+if __name__ == '__main__':
+    unittest.main()
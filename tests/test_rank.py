@@ -0,0 +1,70 @@
+""" Check that every tolerance rank() can produce is free of crossings.
+
+Lines are arranged so that some collapses are rejected for crossing a
+neighboring line and retried once it has moved out of the way.
+
+Run with:
+
+  python -m unittest discover tests
+"""
+import unittest
+from random import Random
+
+import numpy
+
+from Bloch import Datasource, insert_line, flush_lines, crossings
+
+def make_datasource(store, count=40, seed=0):
+    """ Return a new Datasource with count pairs of interlocking lines.
+        
+        Each pair is a shallow peak over a deeper notch, like the lines
+        [(0, 0), (5, 1), (10, 0)] and [(3, .5), (5, -3), (7, .5)]: the peak
+        can only be flattened after the notch has been.
+    """
+    random = Random(seed)
+    datasource = Datasource(None, None, [], [[] for k in range(count * 2)], None, store, areas=[0] * count * 2)
+    
+    for k in range(count):
+        x, y = (k % 8) * 20, (k / 8) * 20
+        peak, notch, shoulder = random.uniform(.5, 1.5), random.uniform(2, 4), random.uniform(.1, .25)
+        
+        insert_line(datasource, k * 2, None, [(x, y), (x + 5, y + peak), (x + 10, y)])
+        insert_line(datasource, k * 2 + 1, None, [(x + 3, y + shoulder), (x + 5, y - notch), (x + 7, y + shoulder)])
+    
+    flush_lines(datasource)
+    
+    return datasource
+
+def crossing_count(lines):
+    """ Return the number of pairs of segments that cross in a list of lines.
+    """
+    segments = [(x1, y1, x2, y2) for (line_id, src1_id, src2_id, points) in lines
+                for ((x1, y1), (x2, y2)) in zip(points[:-1], points[1:])]
+    
+    coords = numpy.array(segments, numpy.float64).reshape(-1, 4)
+    
+    return sum([crossings(x1, y1, x2, y2, coords).sum() for (x1, y1, x2, y2) in segments]) / 2
+
+class RankTests(unittest.TestCase):
+    
+    def check_rank(self, store):
+        datasource = make_datasource(store)
+        self.assertEqual(crossing_count(datasource.lines()), 0)
+        
+        stats = datasource.rank(4)
+        
+        # retries must have happened for this test to mean anything.
+        self.assertTrue(stats['rejected'] > 0)
+        self.assertEqual(crossing_count(datasource.lines()), 0)
+        
+        for tolerance in (.5, 1, 1.5, 2, 2.5, 3, 3.5, 4):
+            self.assertEqual(crossing_count(datasource.lines(tolerance)), 0, 'crossings at %s' % tolerance)
+    
+    def test_array(self):
+        self.check_rank('array')
+    
+    def test_sqlite(self):
+        self.check_rank('sqlite')
+
+if __name__ == '__main__':
+    unittest.main()
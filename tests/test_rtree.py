@@ -0,0 +1,83 @@
+""" Check that simplify() keeps the spatial index in step with the segments.
+
+Datasources are built straight from shapely shapes without OGR, and after
+each simplification the index is compared to one rebuilt from scratch.
+
+Run with:
+
+  python -m unittest discover tests
+"""
+import unittest
+
+from rtree import Rtree
+from shapely.geometry import Polygon
+
+from Bloch import Datasource, pairings, populate_unshared_segments, populate_arcs, flush_lines, bbox
+from benchmarks.synthetic import voronoi_coverage
+
+def make_datasource(store, builder):
+    """ Return a new Datasource with segments for a small Voronoi coverage.
+    """
+    shapes = [Polygon(rings[0], rings[1:]) for rings in voronoi_coverage(60, 6, holes=3)]
+    datasource = Datasource(None, None, [], [[] for shape in shapes], shapes, store)
+    
+    if builder == 'arcs':
+        populate_arcs(datasource)
+    
+    else:
+        shared_borders = pairings['rtree'](datasource)
+        populate_unshared_segments(datasource, shared_borders)
+    
+    flush_lines(datasource)
+    
+    return datasource
+
+def query_boxes(boxes):
+    """ Return a list of query boxes covering some or all of the given boxes.
+    """
+    xmin, ymin = min([box[0] for box in boxes]), min([box[1] for box in boxes])
+    xmax, ymax = max([box[2] for box in boxes]), max([box[3] for box in boxes])
+    xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+    
+    queries = [(xmin, ymin, xmax, ymax), (xmin, ymin, xmid, ymid), (xmid, ymid, xmax, ymax),
+               (xmin, ymid, xmid, ymax), (xmid - 1, ymid - 1, xmid + 1, ymid + 1)]
+    
+    # small boxes around a spread of individual segments
+    for (x1, y1, x2, y2) in boxes[::len(boxes) / 20 + 1]:
+        queries.append((x1 - .1, y1 - .1, x2 + .1, y2 + .1))
+    
+    return queries
+
+class RtreeTests(unittest.TestCase):
+    
+    def assertIndexMatches(self, datasource):
+        live = [(guid, bbox(x1, y1, x2, y2)) for (guid, x1, y1, x2, y2) in datasource.segments.live_segments()]
+        rebuilt = Rtree([(guid, box, None) for (guid, box) in live])
+        
+        for query in query_boxes([box for (guid, box) in live]):
+            self.assertEqual(sorted(datasource.rtree.intersection(query)),
+                             sorted(rebuilt.intersection(query)))
+    
+    def check_simplify(self, store, builder, workers=None):
+        datasource = make_datasource(store, builder)
+        self.assertIndexMatches(datasource)
+        
+        for tolerance in (.02, .1, .4):
+            stats = datasource.simplify(tolerance, workers=workers)
+            self.assertTrue(stats['removed'] > 0)
+            self.assertIndexMatches(datasource)
+    
+    def test_sqlite_overlay(self):
+        self.check_simplify('sqlite', 'overlay')
+    
+    def test_array_overlay(self):
+        self.check_simplify('array', 'overlay')
+    
+    def test_array_arcs(self):
+        self.check_simplify('array', 'arcs')
+    
+    def test_array_arcs_pooled(self):
+        self.check_simplify('array', 'arcs', workers=2)
+
+if __name__ == '__main__':
+    unittest.main()